@@ -1,21 +1,20 @@
-import pandas as pd
-import panel as pn
-from datetime import datetime, timedelta
+from startup_report import timed, log_report
 
-from ads_analytics import (
-    get_facebook_ads_campaign_metrics,
-    get_google_ads_campaign_metrics,
-)
-from google_analytics import get_landing_page_report
-from hubspot_conversions import get_hubspot_conversions
-from sales import get_sales_data
-
-from panels import (
-    key_metrics,
-    conversion_attribution,
-    kpi,
-    new_business_funnel,
-)
+with timed("import panel and pandas"):
+    import pandas as pd
+    import panel as pn
+    from datetime import datetime, timedelta
+
+with timed("import data sources"):
+    import fetch_api
+
+with timed("import panels"):
+    from panels import (
+        key_metrics,
+        conversion_attribution,
+        kpi,
+        new_business_funnel,
+    )
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
@@ -70,46 +69,63 @@ for filter_type, filter_options in GLOBAL_FILTERS.items():
             )
 
 
-@pn.cache(ttl=3600, to_disk=True)
-def get_daily_data() -> pd.DataFrame:
-    """Fetch all data sources and combine into a single dataframe with a datetime index.
-    Returns:
-        pd.DataFrame: A dataframe with a datetime index.
-    """
-    hs = get_hubspot_conversions(filters=None)
-    sales = get_sales_data()
-    fb = get_facebook_ads_campaign_metrics()
-    ga = get_google_ads_campaign_metrics()
-    lp = get_landing_page_report()
-    data = pd.concat([hs, sales, fb, ga, lp]).infer_objects().convert_dtypes()
-    # Ensure index is datetime
-    data.index = pd.to_datetime(data.index)
-    return data
-
-
-data = get_daily_data()
-
-
-# Instantiate the template with widgets displayed in the sidebar
-template = pn.template.FastGridTemplate(
-    title="LALIA Analytics Dashboard",
-    sidebar=GLOBAL_FILTER_WIDGETS.values(),
-    sidebar_width=250,
-    collapsed_sidebar=True,
-    theme="dark",
+# Serve the last persisted data right away, outdated data is refreshed in the background
+with timed("load data snapshot"):
+    data = fetch_api.get_daily_data()
+# the version of this frame, the store may already be newer while it's re-read
+data_version = data.attrs["data_version"]
+# sources that failed or timed out are missing from the combined data
+missing_sources = {
+    name: status
+    for name, status in data.attrs.get("source_status", {}).items()
+    if status != "ok"
+}
+source_status_alert = pn.pane.Alert(
+    "Missing data sources: "
+    + ", ".join(f"{name} ({status})" for name, status in missing_sources.items()),
+    alert_type="warning",
+    visible=bool(missing_sources),
+)
+new_data_alert = pn.pane.Alert(
+    "New data is available, reload the page to see it.",
+    alert_type="info",
+    visible=False,
 )
 
 
-key_metrics_settings, key_metrics_chart = key_metrics.key_metrics_panel(
-    data, GLOBAL_FILTER_WIDGETS
-)
-template.main[0, :] = kpi.KPI_panel(data, GLOBAL_FILTER_WIDGETS)
-template.main[1:6, 0:3] = key_metrics_settings
-template.main[1:6, 3:] = key_metrics_chart
-template.main[6:, :] = conversion_attribution.conversion_attribution_panel(
-    data, GLOBAL_FILTER_WIDGETS
-)
-template.main[11:16, :] = new_business_funnel.get_funnel_sankey_panel()
+def check_for_new_data():
+    if fetch_api.daily_data_version() != data_version:
+        new_data_alert.visible = True
+
+
+pn.state.add_periodic_callback(check_for_new_data, period=60_000)
+
+
+with timed("build layout"):
+    # Instantiate the template with widgets displayed in the sidebar
+    template = pn.template.FastGridTemplate(
+        title="LALIA Analytics Dashboard",
+        sidebar=[source_status_alert, *GLOBAL_FILTER_WIDGETS.values()],
+        sidebar_width=250,
+        collapsed_sidebar=True,
+        theme="dark",
+    )
+    template.header.append(new_data_alert)
+
+    key_metrics_settings, key_metrics_chart = key_metrics.key_metrics_panel(
+        data, GLOBAL_FILTER_WIDGETS
+    )
+    template.main[0, :] = kpi.KPI_panel(data, GLOBAL_FILTER_WIDGETS)
+    template.main[1:6, 0:3] = key_metrics_settings
+    template.main[1:6, 3:] = key_metrics_chart
+    template.main[6:, :] = conversion_attribution.conversion_attribution_panel(
+        data, GLOBAL_FILTER_WIDGETS
+    )
+    # The funnel queries Hubspot, so it's loaded after the page is served
+    template.main[11:16, :] = pn.panel(
+        new_business_funnel.get_funnel_sankey_panel, defer_load=True
+    )
+
 # template.main.extend(
 #     [
 #         kpi.KPI_panel(data, GLOBAL_FILTER_WIDGETS),
@@ -121,3 +137,4 @@ template.main[11:16, :] = new_business_funnel.get_funnel_sankey_panel()
 # )
 
 template.servable()
+log_report()
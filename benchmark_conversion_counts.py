@@ -0,0 +1,77 @@
+"""
+Benchmark of the daily conversion counting in get_hubspot_conversions.
+
+Compares the per group resampler with count_daily_conversions on synthetic
+conversions and checks that both produce the same result.
+
+Usage:
+    python benchmark_conversion_counts.py
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from data_sources.attribution import UTM_COLUMNS
+from data_sources.hubspot_conversions import count_daily_conversions
+
+SIZES = [10_000, 100_000, 1_000_000]
+GROUP_COLUMNS = ["meeting_owner_name"] + UTM_COLUMNS + ["conversion"]
+
+
+def make_conversions(n: int, seed: int = 0) -> pd.DataFrame:
+    """Random conversions over a year, with about 2k owner x UTM combinations."""
+    rng = np.random.default_rng(seed)
+    values = {
+        "meeting_owner_name": [f"Owner {i}" for i in range(8)],
+        "utm_campaign": [f"campaign_{i}" for i in range(20)],
+        "utm_source": ["facebook", "google", "unknown"],
+        "utm_medium": ["cpc", "unknown"],
+        "utm_content": ["content_1", "content_2"],
+        "utm_term": ["unknown"],
+        "conversion": [
+            "First Call",
+            "Verbal agreement after first call",
+            "Placement scheduled",
+        ],
+    }
+    conversions = pd.DataFrame(
+        {column: rng.choice(options, n) for column, options in values.items()}
+    )
+    start = pd.Timestamp("2024-01-01", tz="UTC").value
+    seconds = rng.integers(0, 365 * 24 * 3600, n) * 1_000_000_000
+    conversions.index = pd.DatetimeIndex(start + seconds, tz="UTC", name="date")
+    return conversions
+
+
+def count_with_resample(conversions: pd.DataFrame) -> pd.DataFrame:
+    """The previous implementation, one resampler per group."""
+    return (
+        conversions.groupby(GROUP_COLUMNS)
+        .resample("D")
+        .size()
+        .unstack("conversion")
+        .fillna(0)
+    )
+
+
+def timed(func, *args) -> tuple:
+    start_time = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    print(f"{'conversions':>12}{'resample':>12}{'vectorized':>12}{'speedup':>10}")
+    for n in SIZES:
+        conversions = make_conversions(n)
+        expected, resample_seconds = timed(count_with_resample, conversions)
+        result, vectorized_seconds = timed(
+            count_daily_conversions, conversions, GROUP_COLUMNS
+        )
+        pd.testing.assert_frame_equal(result, expected, check_names=False)
+        print(
+            f"{n:>12,}{resample_seconds:>11.2f}s{vectorized_seconds:>11.2f}s"
+            f"{resample_seconds / vectorized_seconds:>9.1f}x"
+        )
@@ -6,67 +6,167 @@ metrics (like spend, impressions, clicks, reach) from both platforms.
 It then parses and formats the data into pandas DataFrames for analysis.
 """
 
+import numpy as np
 import pandas as pd
 import logging
-from api_clients.google_ads_api import GoogleAdsAPIWrapper
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from itertools import chain, islice
+from facebook_business.exceptions import FacebookRequestError
 from api_clients.facebook_api import get_campaign_insights, get_campaigns
+from data_sources.retry import call_with_retry
 import time
 
-google_ads_client = GoogleAdsAPIWrapper()
+
+@cache
+def get_google_ads_client():
+    """Create the Google Ads client on first use, importing and authenticating it
+    is too slow to do at import time."""
+    from api_clients.google_ads_api import GoogleAdsAPIWrapper
+
+    return GoogleAdsAPIWrapper()
+
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Maximum number of concurrent Facebook insights requests
+FB_MAX_CONCURRENT_REQUESTS = 8
+# Facebook error codes for (application, user, page and ad account) rate limits
+FB_RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613, 80000, 80003, 80004}
+
+# Number of API records that are converted to columns at a time
+PARSE_CHUNK_SIZE = 100_000
+
+# Declared column types of the parsed responses, undeclared metrics are parsed as
+# float64. int64 columns fall back to float64 if values are missing.
+GOOGLE_ADS_SCHEMA = {
+    "campaign_name": "string",
+    "date": "datetime64[ns]",
+    "hour": "int64",
+    "clicks": "int64",
+    "impressions": "int64",
+    "costMicros": "int64",
+    "conversions": "float64",
+    "ctr": "float64",
+    "averageCpc": "float64",
+}
+FB_INSIGHTS_SCHEMA = {
+    "campaign_name": "string",
+    "date": "datetime64[ns]",
+    "spend": "float64",
+    "impressions": "int64",
+    "clicks": "int64",
+    "reach": "int64",
+    "hourly_stats_aggregated_by_advertiser_time_zone": "string",
+}
+
+
+def _to_typed_column(values: list, dtype: str):
+    """Convert the raw values of a column in one pass to an array of the declared type."""
+    if dtype == "datetime64[ns]":
+        return pd.to_datetime(values)
+    if dtype == "string":
+        return pd.array(values, dtype="string")
+    # numeric values arrive as strings or numbers, missing values as None
+    array = np.fromiter(
+        (np.nan if v is None else v for v in values),
+        dtype=np.float64,
+        count=len(values),
+    )
+    if dtype == "int64" and not np.isnan(array).any():
+        return array.astype(np.int64)
+    return array
+
+
+def _parse_in_chunks(records, parse_chunk) -> pd.DataFrame | None:
+    """Parse an iterable of records in fixed size chunks, so only one chunk of raw
+    Python objects is converted at a time."""
+    records = iter(records)
+    frames = []
+    while chunk := list(islice(records, PARSE_CHUNK_SIZE)):
+        frames.append(parse_chunk(chunk))
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+
+def _parse_google_ads_chunk(campaigns: list) -> pd.DataFrame:
+    n = len(campaigns)
+    columns = {"campaign_name": [None] * n, "date": [None] * n, "hour": [None] * n}
+    for i, campaign in enumerate(campaigns):
+        columns["campaign_name"][i] = campaign["campaign"].get("name", "Unknown")
+        columns["date"][i] = campaign["segments"].get("date", "Unknown")
+        # only segmented by hour for hourly reports
+        columns["hour"][i] = campaign["segments"].get("hour")
+        for key, value in campaign["metrics"].items():
+            if key not in columns:
+                columns[key] = [None] * n
+            columns[key][i] = value
+    return pd.DataFrame(
+        {
+            key: _to_typed_column(values, GOOGLE_ADS_SCHEMA.get(key, "float64"))
+            for key, values in columns.items()
+        }
+    )
+
 
 def parse_google_ads_campaigns_to_dataframe(campaigns):
     """
     Parse Google Ads campaign data into a pandas DataFrame.
 
     Args:
-        campaigns (list): List of dictionaries containing campaign data
+        campaigns (iterable): Iterable of dictionaries containing campaign data
 
     Returns:
         pandas.DataFrame: DataFrame with campaign name and date as indices and metrics as columns
     """
-    # Create a list to store the processed data
-    data = []
-
-    # Process each campaign
-    for campaign in campaigns:
-        # Extract campaign name
-        campaign_name = campaign["campaign"].get("name", "Unknown")
-
-        # Extract date
-        date = campaign["segments"].get("date", "Unknown")
-
-        # Extract metrics
-        metrics = campaign["metrics"]
-
-        # Create a row with campaign name, date, and all metrics
-        row = {"campaign_name": campaign_name, "date": date, **metrics}
-
-        data.append(row)
-
-    # Create DataFrame
-    df = pd.DataFrame(data)
-
-    # Convert date to datetime
-    df["date"] = pd.to_datetime(df["date"])
-
-    # Convert numeric columns to appropriate types
-    numeric_columns = df.columns.difference(["campaign_name", "date"])
-    for col in numeric_columns:
-        df[col] = pd.to_numeric(df[col])
+    df = _parse_in_chunks(campaigns, _parse_google_ads_chunk)
+    if df is None:
+        df = pd.DataFrame(
+            {"campaign_name": pd.array([], dtype="string"), "date": pd.to_datetime([])}
+        )
 
     if "costMicros" in df.columns:
         df["cost"] = df["costMicros"] / 1_000_000
 
+    # Hourly rows are dated by the start of their hour
+    if "hour" in df.columns:
+        hours = df.pop("hour")
+        if hours.notna().any():
+            df["date"] = df["date"] + pd.to_timedelta(hours.fillna(0), unit="h")
+
     # Set campaign_name and date as index
     df = df.set_index("date").sort_index()
 
     return df
 
 
+def _parse_fb_insights_chunk(insights: list) -> pd.DataFrame:
+    n = len(insights)
+    columns = {"campaign_name": [None] * n, "date": [None] * n}
+    for i, insight in enumerate(insights):
+        # read the fields directly instead of copying them with export_all_data()
+        for key, value in insight.items():
+            if key == "campaign_name":
+                columns["campaign_name"][i] = value
+            elif key == "date_start":
+                columns["date"][i] = value
+            elif key != "date_stop":  # Often redundant with date_start for daily data
+                if key not in columns:
+                    columns[key] = [None] * n
+                columns[key][i] = value
+    columns["campaign_name"] = [
+        "Unknown" if v is None else v for v in columns["campaign_name"]
+    ]
+    return pd.DataFrame(
+        {
+            key: _to_typed_column(values, FB_INSIGHTS_SCHEMA.get(key, "float64"))
+            for key, values in columns.items()
+        }
+    )
+
+
 def parse_fb_insights_to_dataframe(campaign_insights):
     """
     Parse Facebook campaign insights data into a pandas DataFrame.
@@ -77,57 +177,20 @@ def parse_fb_insights_to_dataframe(campaign_insights):
     Returns:
         pandas.DataFrame: DataFrame with campaign name and date as indices and metrics as columns
     """
-    # Create a list to store the processed data
-    data = []
-
-    # Process each campaign's insights
-    for insights_list in campaign_insights:
-        # Skip empty lists
-        if not insights_list:
-            continue
-
-        # Process each insight in the list
-        for insight in insights_list:
-            # Convert the AdsInsights object to a dictionary
-            insight_dict = insight.export_all_data()
-
-            # Extract campaign name and date (required fields)
-            campaign_name = insight_dict.get("campaign_name", "Unknown")
-            date = insight_dict.get("date_start", "Unknown")
-
-            # Remove the fields we're using as indices to avoid duplication
-            insight_dict.pop("campaign_name", None)
-            insight_dict.pop("date_start", None)
-            insight_dict.pop(
-                "date_stop", None
-            )  # Often redundant with date_start for daily data
-
-            # Create a row with campaign name, date, and all remaining metrics
-            row = {
-                "campaign_name": campaign_name,
-                "date": date,
-                **insight_dict,  # Include all remaining fields as metrics
-            }
-
-            data.append(row)
-
-    # Create DataFrame
-    df = pd.DataFrame(data)
+    df = _parse_in_chunks(
+        chain.from_iterable(campaign_insights), _parse_fb_insights_chunk
+    )
 
     # If DataFrame is empty, return empty DataFrame with proper structure
-    if df.empty:
+    if df is None:
         return pd.DataFrame(columns=["campaign_name", "date"]).set_index(
             ["campaign_name", "date"]
         )
 
-    # Convert date to datetime
-    df["date"] = pd.to_datetime(df["date"])
-
-    # Convert numeric columns to appropriate types
-    # Exclude campaign_name and date from numeric conversion
-    numeric_columns = df.columns.difference(["campaign_name", "date"])
-    for col in numeric_columns:
-        df[col] = pd.to_numeric(df[col], errors="coerce")
+    # Hourly rows are dated by the start of their hour, e.g. "13:00:00 - 13:59:59"
+    hourly_column = "hourly_stats_aggregated_by_advertiser_time_zone"
+    if hourly_column in df.columns:
+        df["date"] = df["date"] + pd.to_timedelta(df.pop(hourly_column).str[:8])
 
     # Set campaign_name and date as index
     df = df.set_index("date").sort_index()
@@ -135,10 +198,44 @@ def parse_fb_insights_to_dataframe(campaign_insights):
     return df
 
 
+def is_retryable_fb_error(e: Exception) -> bool:
+    """Whether a failed Facebook request is transient (rate limit or server error)."""
+    if not isinstance(e, FacebookRequestError):
+        return False
+    return (
+        e.api_transient_error()
+        or e.api_error_code() in FB_RATE_LIMIT_ERROR_CODES
+        or (e.http_status() or 0) >= 500
+    )
+
+
+def get_fb_campaigns_insights(campaigns, fields: list, params: dict) -> list:
+    """
+    Retrieve the insights of the campaigns with bounded concurrency.
+
+    Failed requests are retried with exponential backoff if the error is transient.
+
+    Returns:
+        list: List of lists containing AdsInsights objects, in the order of the campaigns
+    """
+
+    def fetch_insights(campaign_id):
+        # insights may be a lazy cursor, iterate it here so paging runs in the worker
+        return list(get_campaign_insights(campaign_id, fields=fields, params=params))
+
+    def get_insights(campaign):
+        return call_with_retry(
+            fetch_insights, campaign.get_id(), is_retryable=is_retryable_fb_error
+        )
+
+    with ThreadPoolExecutor(max_workers=FB_MAX_CONCURRENT_REQUESTS) as executor:
+        return list(executor.map(get_insights, campaigns))
+
+
 def get_google_ads_campaign_metrics(hourly: bool = False):
     start_time = time.time()
     logger.info("Retrieving Google Ads campaign metrics")
-    campaigns = google_ads_client.get_campaigns(hourly=hourly)
+    campaigns = get_google_ads_client().get_campaigns(hourly=hourly)
     df = parse_google_ads_campaigns_to_dataframe(campaigns)
     logger.info(
         f"Retrieved Google Ads campaign metrics in {round(time.time() - start_time, 2)} seconds"
@@ -202,11 +299,7 @@ def get_facebook_ads_campaign_metrics(
     else:
         raise ValueError("Either date_preset or since and until must be provided")
     fb_campaigns = get_campaigns(params=params)
-    campaign_insights = []
-    for campaign in fb_campaigns:
-        campaign_insights.append(
-            get_campaign_insights(campaign.get_id(), fields=fields, params=params)
-        )
+    campaign_insights = get_fb_campaigns_insights(fb_campaigns, fields, params)
     # Create DataFrame from Facebook campaign insights
     fb_campaign_df = parse_fb_insights_to_dataframe(campaign_insights)
 
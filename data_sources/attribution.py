@@ -0,0 +1,128 @@
+"""
+Shared email -> UTM attribution index for conversions and sales.
+
+The index maps normalized (stripped, lower case) emails to the UTM parameters of
+their Calendly first call booking. It is built once from the exported Calendly first
+call data, persisted as a pickle and extended incrementally with new Calendly events
+since its watermark.
+"""
+
+import datetime
+import logging
+import os
+import threading
+
+import pandas as pd
+from dotenv import load_dotenv
+from data_sources.calendly_data import get_calendly_data
+
+load_dotenv()
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+UTM_COLUMNS = [
+    "utm_campaign",
+    "utm_source",
+    "utm_medium",
+    "utm_content",
+    "utm_term",
+]
+CALENDLY_EXPORT_PATH = "./data/calendly_first_call_data.csv"
+INDEX_PATH = "./data/attribution_index.pkl"
+
+_index = None
+_index_lock = threading.RLock()
+
+
+def normalize_emails(emails) -> pd.Series:
+    return pd.Series(emails, dtype="string").str.strip().str.lower()
+
+
+def _to_index(calendly_data: pd.DataFrame) -> pd.DataFrame:
+    """Index calendly data by normalized email, later bookings replace earlier ones."""
+    index = calendly_data.reindex(columns=UTM_COLUMNS)
+    index.index = pd.Index(normalize_emails(calendly_data["email"].values))
+    index.index.name = "email"
+    return index[~index.index.duplicated(keep="last") & index.index.notna()]
+
+
+def _save_index(index: pd.DataFrame):
+    index.to_pickle(INDEX_PATH + ".tmp")
+    os.replace(INDEX_PATH + ".tmp", INDEX_PATH)
+
+
+def get_index() -> pd.DataFrame:
+    """Load the attribution index, building it from the Calendly export on first use.
+
+    Returns:
+        pd.DataFrame: UTM columns indexed by normalized email. The watermark (time up
+            to which Calendly events are included) is stored in `index.attrs["watermark"]`.
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            if os.path.exists(INDEX_PATH):
+                _index = pd.read_pickle(INDEX_PATH)
+            else:
+                logger.info("Building attribution index from the calendly export")
+                _index = _to_index(
+                    pd.read_csv(CALENDLY_EXPORT_PATH).sort_values(by="created_at")
+                )
+                _index.attrs["watermark"] = datetime.datetime.strptime(
+                    os.getenv("FIRST_CALL_DATA_UPDATED_AT"), "%Y-%m-%d"
+                )
+                _save_index(_index)
+        return _index
+
+
+def update_index(until) -> pd.DataFrame:
+    """Extend the index with the Calendly events since its watermark if `until` is
+    after the watermark, e.g. the date of the latest conversion."""
+    global _index
+    until = pd.Timestamp(until)
+    # Convert both timestamps to naive for comparison
+    if until.tzinfo:
+        until = until.tz_localize(None)
+    with _index_lock:
+        index = get_index()
+        watermark = index.attrs["watermark"]
+        if until <= watermark:
+            return index
+
+        logger.info(f"Retrieving new calendly data since {watermark}")
+        sync_started_at = datetime.datetime.now()
+        new_calendly_data = get_calendly_data(watermark)
+        if not new_calendly_data.empty:
+            # Combine with the existing index, preferring newer data if duplicates
+            index = pd.concat([index, _to_index(new_calendly_data)])
+            index = index[~index.index.duplicated(keep="last")]
+        index.attrs["watermark"] = sync_started_at
+        _save_index(index)
+        _index = index
+        return index
+
+
+def lookup_utm(email: str) -> tuple | None:
+    """UTM parameters (campaign, source, medium, content, term) of an email."""
+    index = get_index()
+    email = normalize_emails([email]).iloc[0]
+    if pd.isna(email) or email not in index.index:
+        return None
+    return tuple(index.loc[email, UTM_COLUMNS])
+
+
+def join_utm(df: pd.DataFrame, email_column: str) -> pd.DataFrame:
+    """Add the UTM columns of the emails in `email_column` to the dataframe.
+
+    Missing UTM values are filled with "unknown".
+    """
+    index = get_index()
+    positions = index.index.get_indexer(normalize_emails(df[email_column].values))
+    found = positions >= 0
+    df = df.copy()
+    for col in UTM_COLUMNS:
+        values = pd.Series("unknown", index=df.index, dtype=object)
+        values[found] = index[col].to_numpy()[positions[found]]
+        df[col] = values.fillna("unknown")
+    return df
@@ -0,0 +1,115 @@
+"""
+Fetches first call events and their invitees from Calendly.
+
+Invitees are looked up concurrently and kept in a persistent cache keyed by the event
+UUID, so every event is only resolved once.
+"""
+
+import datetime
+import logging
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import requests
+from api_clients import calendly_api as calendly
+from data_sources.retry import call_with_retry
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INVITEE_CACHE_PATH = "./data/calendly_invitees.pkl"
+# Maximum number of concurrent invitee requests
+MAX_CONCURRENT_REQUESTS = 8
+
+_invitee_cache_lock = threading.Lock()
+
+
+def load_invitee_cache() -> dict:
+    """Load the {event_uuid: invitee} cache, empty if it doesn't exist yet."""
+    if not os.path.exists(INVITEE_CACHE_PATH):
+        return {}
+    with open(INVITEE_CACHE_PATH, "rb") as f:
+        return pickle.load(f)
+
+
+def save_invitee_cache(invitees: dict):
+    with open(INVITEE_CACHE_PATH + ".tmp", "wb") as f:
+        pickle.dump(invitees, f)
+    os.replace(INVITEE_CACHE_PATH + ".tmp", INVITEE_CACHE_PATH)
+
+
+def is_retryable_request_error(e: Exception) -> bool:
+    """Whether a failed request is transient (connection error, rate limit or server error)."""
+    if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return False
+
+
+def get_event_invitee(uuid: str) -> dict:
+    """Get the (first) invitee of an event, empty if the event has no invitees."""
+    invitees = call_with_retry(
+        calendly.list_event_invitees, uuid, is_retryable=is_retryable_request_error
+    )
+    return invitees[0] if invitees else {}
+
+
+def get_event_invitees(uuids: list) -> dict:
+    """Get the invitees of the events, only events missing in the cache are fetched.
+
+    Events without invitees aren't cached, an empty response may be transient, so they
+    are fetched again on the next call.
+
+    Returns:
+        dict: {event_uuid: invitee}
+    """
+    # concurrent callers wait for each other, so events are not resolved twice
+    with _invitee_cache_lock:
+        invitees = load_invitee_cache()
+        missing = [uuid for uuid in dict.fromkeys(uuids) if uuid not in invitees]
+        if not missing:
+            return invitees
+
+        logger.info(f"Retrieving invitees of {len(missing)} calendly events")
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            fetched = dict(zip(missing, executor.map(get_event_invitee, missing)))
+        resolved = {uuid: invitee for uuid, invitee in fetched.items() if invitee}
+        if resolved:
+            invitees.update(resolved)
+            save_invitee_cache(invitees)
+    return {**fetched, **invitees}
+
+
+def get_calendly_data(start_date: datetime.datetime):
+    logger.info("Retrieving calendly data")
+    start_time = time.time()
+    calendly_meetings = calendly.list_events(min_start_time=start_date)
+    calendly_meetings_df = pd.DataFrame(calendly_meetings)
+    first_calls_df = calendly_meetings_df.loc[
+        calendly_meetings_df.name.str.lower() == "first call with lalia"
+    ].set_index("created_at")
+    first_calls_df.index = pd.to_datetime(first_calls_df.index)
+    first_calls_df.sort_index(inplace=True)
+    first_calls_df["uuid"] = first_calls_df.uri.str.split("/").str[-1]
+    invitees = get_event_invitees(first_calls_df.uuid.tolist())
+    calendly_data = pd.DataFrame(
+        [invitees[uuid] for uuid in first_calls_df.uuid], index=first_calls_df.index
+    )
+    # Flatten the tracking (UTM) fields into columns
+    if "tracking" in calendly_data.columns:
+        tracking = pd.DataFrame(
+            [t if isinstance(t, dict) else {} for t in calendly_data.tracking],
+            index=calendly_data.index,
+        )
+        calendly_data = pd.concat(
+            [calendly_data.drop(columns=["tracking"]), tracking], axis=1
+        )
+    logger.info(
+        f"Retrieved {len(calendly_data)} meetings from calendly in {round(time.time() - start_time, 2)} seconds"
+    )
+    return calendly_data
@@ -9,7 +9,9 @@ including session data, engagement metrics, and traffic source dimensions.
 
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import numpy as np
 import pandas as pd
 import time
 
@@ -22,16 +24,31 @@ from google.analytics.data_v1beta.types import (
     RunReportRequest,
     FilterExpression,
     Filter,
+    MetricType,
+    OrderBy,
 )
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Rows per report page, the API maximum is 250000
+GA_PAGE_SIZE = 100_000
+
+# Report rows fetched so far, so the history isn't limited to the initial window
+LANDING_PAGE_HISTORY_PATH = "./data/ga_landing_page_history.pkl"
+# Window of the first (full) fetch
+LANDING_PAGE_INITIAL_WINDOW = "90daysAgo"
+# GA4 keeps processing data for a few days, so the last days are fetched again
+GA_RESYNC_DAYS = 3
+
 
 def response_to_dataframe(response):
     """
     Transform a Google Analytics API response into a pandas DataFrame.
 
+    The values are collected per column in one pass, metrics are converted to numbers
+    according to their metric type.
+
     Args:
         response: The response object from the Google Analytics API
 
@@ -44,20 +61,21 @@ def response_to_dataframe(response):
     dimension_names = [dim.name for dim in response.dimension_headers]
     metric_names = [metric.name for metric in response.metric_headers]
 
-    # Create a list to store the data
-    data = []
-
-    # Process each row in the response
+    # Collect the values per column
+    columns = [[] for _ in dimension_names + metric_names]
     for row in response.rows:
-        # Extract dimension values
-        dimension_values = [dim_value.value for dim_value in row.dimension_values]
+        for column, value in zip(columns, row.dimension_values):
+            column.append(value.value)
+        for column, value in zip(columns[len(dimension_names) :], row.metric_values):
+            column.append(value.value)
 
-        # Extract metric values
-        metric_values = [metric_value.value for metric_value in row.metric_values]
-
-        # Combine dimension and metric values
-        row_data = dimension_values + metric_values
-        data.append(row_data)
+    data = {
+        name: pd.array(values, dtype="string")
+        for name, values in zip(dimension_names, columns)
+    }
+    for header, values in zip(response.metric_headers, columns[len(dimension_names) :]):
+        dtype = np.int64 if header.type_ == MetricType.TYPE_INTEGER else np.float64
+        data[header.name] = np.array(values, dtype=np.float64).astype(dtype)
 
     # Create DataFrame
     df = pd.DataFrame(data, columns=dimension_names + metric_names)
@@ -69,11 +87,127 @@ def response_to_dataframe(response):
     return df
 
 
-def get_landing_page_report():
+def run_report_paged(
+    client: BetaAnalyticsDataClient,
+    request: RunReportRequest,
+    page_size: int = GA_PAGE_SIZE,
+    concurrent: bool = False,
+    max_workers: int = 4,
+) -> pd.DataFrame:
+    """
+    Run a report page by page, so results are not truncated to a single page.
+
+    Every page is converted to a DataFrame as soon as it arrives, so only the raw
+    response of a page (or max_workers pages if concurrent) is held at a time.
+
+    Args:
+        client (BetaAnalyticsDataClient): Google Analytics Data API client
+        request (RunReportRequest): The report request, limit and offset are overwritten
+        page_size (int, optional): Rows per page, at most 250000. Defaults to GA_PAGE_SIZE.
+        concurrent (bool, optional): Fetch the pages after the first one concurrently. Defaults to False.
+        max_workers (int, optional): Maximum number of concurrent page requests. Defaults to 4.
+
+    Returns:
+        pandas.DataFrame: The combined DataFrame of all pages
+
+    Raises:
+        RuntimeError: If the pages don't add up to the rows of the report, e.g. because
+            the report changed while paging.
+    """
+    # Pages are only consistent with a stable row order. Rows are unique per
+    # combination of dimensions, so ordering by all of them is deterministic
+    if not request.order_bys:
+        request = RunReportRequest(
+            request,
+            order_bys=[
+                OrderBy(dimension=OrderBy.DimensionOrderBy(dimension_name=d.name))
+                for d in request.dimensions
+            ],
+        )
+
+    def get_page(offset):
+        page_request = RunReportRequest(request, limit=page_size, offset=offset)
+        return response_to_dataframe(client.run_report(page_request))
+
+    # The first page tells the total number of rows
+    first_page_request = RunReportRequest(request, limit=page_size, offset=0)
+    first_page = client.run_report(first_page_request)
+    row_count = first_page.row_count
+    pages = [response_to_dataframe(first_page)]
+    del first_page
+
+    offsets = range(page_size, row_count, page_size)
+    if concurrent:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pages.extend(executor.map(get_page, offsets))
+    else:
+        pages.extend(get_page(offset) for offset in offsets)
+    retrieved = sum(len(page) for page in pages)
+    if retrieved != row_count:
+        raise RuntimeError(
+            f"Retrieved {retrieved} rows in {len(pages)} pages, but the report has {row_count} rows"
+        )
+    logger.info(f"Retrieved {row_count} rows in {len(pages)} pages")
+
+    return pd.concat(pages)
+
+
+def load_history(path: str = LANDING_PAGE_HISTORY_PATH) -> pd.DataFrame:
+    """Load the persisted report rows, returns an empty dataframe if there are none."""
+    if os.path.exists(path):
+        return pd.read_pickle(path)
+    return pd.DataFrame()
+
+
+def merge_history(
+    history: pd.DataFrame,
+    rows: pd.DataFrame,
+    start_date: pd.Timestamp,
+    path: str = LANDING_PAGE_HISTORY_PATH,
+) -> pd.DataFrame:
+    """Replace the days from start_date on with the fetched rows and persist the history.
+
+    Whole days are replaced, so rows GA4 dropped or regrouped while processing late
+    data don't stay in the history.
+    """
+    if not history.empty:
+        history = history[history.date < start_date]
+    history = pd.concat([history, rows], ignore_index=True)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    history.to_pickle(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return history
+
+
+def get_landing_page_report(
+    concurrent: bool = False,
+    incremental: bool = True,
+    resync_days: int = GA_RESYNC_DAYS,
+):
+    """
+    Retrieve sessions, engaged sessions and events per landing page, UTM parameters and day.
+
+    Args:
+        concurrent (bool, optional): Fetch the report pages concurrently. Defaults to False.
+        incremental (bool, optional): Only fetch the days after the last persisted day
+            (plus resync_days) and merge them into the persisted history. Otherwise the
+            initial window is fetched again. Defaults to True.
+        resync_days (int, optional): Number of persisted days fetched again for late GA4
+            processing. Defaults to GA_RESYNC_DAYS.
+    """
     start_time = time.time()
     logger.info("Retrieving landing page report")
     property_id = "346484289"
 
+    history = load_history() if incremental else pd.DataFrame()
+    if history.empty:
+        start_date = LANDING_PAGE_INITIAL_WINDOW
+    else:
+        start_date = (history.date.max() - pd.Timedelta(days=resync_days)).strftime(
+            "%Y-%m-%d"
+        )
+        logger.info(f"Retrieving landing page report since {start_date}")
+
     client = BetaAnalyticsDataClient()
 
     request = RunReportRequest(
@@ -95,7 +229,7 @@ def get_landing_page_report():
             Metric(name="engagedSessions"),
             Metric(name="eventCount"),  # Metric(name="engagementRate"),
         ],
-        date_ranges=[DateRange(start_date="90daysAgo", end_date="today")],
+        date_ranges=[DateRange(start_date=start_date, end_date="today")],
         dimension_filter=FilterExpression(
             filter=Filter(
                 field_name="pageTitle",
@@ -106,16 +240,22 @@ def get_landing_page_report():
             )
         ),
     )
-    response = client.run_report(request)
+    df = run_report_paged(client, request, concurrent=concurrent)
     logger.info(
         f"Retrieved landing page report in {round(time.time() - start_time, 2)} seconds"
     )
 
-    df = response_to_dataframe(response)
     df = df[
         df.index.get_level_values(1).isin(["/hp-2", "/", "(not set)"])
     ].reset_index()
     df.date = pd.to_datetime(df.date)
+    if incremental and not df.empty:
+        # "90daysAgo" is resolved by GA4, so the first fetch starts at its first day
+        fetched_since = df.date.min() if history.empty else pd.Timestamp(start_date)
+        df = merge_history(history, df, fetched_since)
+        logger.info(f"Landing page history has {len(df)} rows")
+    elif incremental and not history.empty:
+        df = history
     df.landingPage = df.hostname.map(
         {
             "lalia-berlin.com": "Zenler ",
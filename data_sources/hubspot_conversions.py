@@ -8,12 +8,14 @@ information to provide a consolidated view of customer conversions.
 
 import logging
 import time
-from api_clients import hubspot_api as hubspot, calendly_api as calendly
+from api_clients import hubspot_api as hubspot
+from data_sources import attribution
+import numpy as np
 import pandas as pd
-import datetime
 import os
 from dotenv import load_dotenv
 import panel as pn
+from single_flight import single_flight
 # from simple_cache import timed_cache, clear_cache
 
 load_dotenv()
@@ -22,16 +24,12 @@ pd.options.mode.chained_assignment = None  # default='warn'
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 deals_df = pd.DataFrame()
-calendly_data = (
-    pd.read_csv("./data/calendly_first_call_data.csv")
-    .set_index("email")
-    .sort_values(by="created_at")
-)
-FIRST_CALL_DATA_UPDATED_AT = datetime.datetime.strptime(
-    os.getenv("FIRST_CALL_DATA_UPDATED_AT"), "%Y-%m-%d"
-)
+# local stores of the synced hubspot objects, keyed by object id
+DEALS_STORE_PATH = "./data/hubspot_deals.pkl"
+FIRST_CALLS_STORE_PATH = "./data/hubspot_first_calls.pkl"
 
 
+@single_flight
 @pn.cache(ttl=60, to_disk=True)
 def get_users():
     response = hubspot.get_client().crm.owners.owners_api.get_page()
@@ -39,12 +37,58 @@ def get_users():
     return users.set_index("id")
 
 
+def load_store(path: str) -> pd.DataFrame:
+    """Load a local object store, returns an empty dataframe if it doesn't exist yet."""
+    if os.path.exists(path):
+        return pd.read_pickle(path)
+    return pd.DataFrame()
+
+
+def upsert_store(path: str, store: pd.DataFrame, changes: pd.DataFrame):
+    """Insert or replace the changed objects in the store (keyed by `id`) and persist it."""
+    if changes.empty:
+        return store
+    store = pd.concat([store, changes]).drop_duplicates(subset=["id"], keep="last")
+    # replaced atomically, a partly written store would corrupt its watermark
+    store.to_pickle(path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return store
+
+
+def modified_since_filter(store: pd.DataFrame) -> list[dict]:
+    """Hubspot search filter for objects modified since the store's watermark.
+
+    The watermark is the latest `hs_lastmodifieddate` in the store. An empty list is
+    returned for an empty store, so everything is fetched.
+    """
+    if store.empty or "hs_lastmodifieddate" not in store.columns:
+        return []
+    watermark = store.hs_lastmodifieddate.max()
+    logger.info(f"Retrieving objects modified since {watermark}")
+    return [
+        {
+            "propertyName": "hs_lastmodifieddate",
+            "operator": "GTE",
+            "value": str(int(watermark.timestamp() * 1000)),
+        }
+    ]
+
+
+@single_flight
 @pn.cache(ttl=3600, to_disk=True)
-def get_deals():
+def get_deals(incremental: bool = True):
+    """Retrieve the deals of the default pipeline.
+
+    Args:
+        incremental (bool, optional): Only fetch deals modified since the last sync and
+            upsert them into the local deal store. Deleted deals and deals moved to
+            another pipeline are only removed by a full refresh. Defaults to True.
+    """
     global deals_df
     logger.info("Retrieving deals from Hubspot")
 
     start_time = time.time()
+    store = load_store(DEALS_STORE_PATH) if incremental else pd.DataFrame()
     deals = hubspot.search_objects(
         object_type="deal",
         filter_groups=[
@@ -54,7 +98,8 @@ def get_deals():
                         "propertyName": "pipeline",
                         "operator": "EQ",
                         "value": "default",
-                    }
+                    },
+                    *modified_since_filter(store),
                 ]
             }
         ],
@@ -74,21 +119,24 @@ def get_deals():
     logger.info(
         f"Retrieved {len(deals)} deals from Hubspot in {round(time.time() - start_time, 2)} seconds"
     )
-    deals_df = pd.DataFrame(deals)
-    deals_df = (
-        pd.concat(
-            [deals_df, deals_df.properties.apply(pd.Series)],
-            axis=1,
+    changes = pd.DataFrame(deals)
+    if not changes.empty:
+        changes = (
+            pd.concat(
+                [changes, changes.properties.apply(pd.Series)],
+                axis=1,
+            )
+            .drop(columns=["properties"])
+            .convert_dtypes()
+        ).rename(columns={"createdAt": "date", "hubspot_owner_id": "meeting_owner_id"})
+        changes.date = pd.to_datetime(changes.date, format="ISO8601")
+        changes.updatedAt = pd.to_datetime(changes.updatedAt, format="ISO8601")
+        changes.hs_lastmodifieddate = pd.to_datetime(
+            changes.hs_lastmodifieddate, format="ISO8601"
         )
-        .drop(columns=["properties"])
-        .convert_dtypes()
-    ).rename(columns={"createdAt": "date", "hubspot_owner_id": "meeting_owner_id"})
-    deals_df.date = pd.to_datetime(deals_df.date, format="ISO8601")
-    deals_df.updatedAt = pd.to_datetime(deals_df.updatedAt, format="ISO8601")
-    deals_df.hs_lastmodifieddate = pd.to_datetime(
-        deals_df.hs_lastmodifieddate, format="ISO8601"
-    )
-    deals_df = deals_df.sort_values(by="date").drop_duplicates(
+    store = upsert_store(DEALS_STORE_PATH, store, changes)
+
+    deals_df = store.sort_values(by="date").drop_duplicates(
         subset=["contact_email"], keep="first"
     )
     deals_df.set_index("date", inplace=True)
@@ -96,28 +144,38 @@ def get_deals():
     return deals_df
 
 
+@single_flight
 @pn.cache(ttl=3600, to_disk=True)
-def get_first_calls():
+def get_first_calls(incremental: bool = True):
+    """Retrieve the first call meetings with the email of the associated contact.
+
+    Args:
+        incremental (bool, optional): Only fetch meetings modified since the last sync
+            and upsert them into the local meeting store. Defaults to True.
+    """
     start_time = time.time()
     logger.info("Retrieving first calls from Hubspot")
+    store = load_store(FIRST_CALLS_STORE_PATH) if incremental else pd.DataFrame()
+    watermark_filter = modified_since_filter(store)
+    # filter groups are ORed and the filters within a group ANDed, so every
+    # alternative of a first call gets its own group restricted by the watermark
+    first_call_filters = [
+        {
+            "propertyName": "hs_meeting_title",
+            "operator": "EQ",
+            "value": "Calendly: First call with LALIA",
+        },
+        {
+            "propertyName": "hs_activity_type",
+            "operator": "EQ",
+            "value": "First Call",
+        },
+    ]
     calendly_first_calls = hubspot.search_objects(
         object_type="meeting",
         filter_groups=[
-            {
-                "filters": [
-                    {
-                        "propertyName": "hs_meeting_title",
-                        "operator": "EQ",
-                        "value": "Calendly: First call with LALIA",
-                    },
-                    {
-                        "propertyName": "hs_activity_type",
-                        "operator": "EQ",
-                        "value": "First Call",
-                    },
-                ],
-                "groupType": "OR",
-            }
+            {"filters": [first_call_filter, *watermark_filter]}
+            for first_call_filter in first_call_filters
         ],
         properties=[
             "hs_meeting_title",
@@ -130,6 +188,22 @@ def get_first_calls():
         association_types=["contacts"],
     )
     first_calls_df = pd.DataFrame(calendly_first_calls)
+    if not first_calls_df.empty:
+        first_calls_df = parse_first_calls(first_calls_df)
+    store = upsert_store(FIRST_CALLS_STORE_PATH, store, first_calls_df)
+
+    first_calls_df = store.drop_duplicates(subset=["id"]).sort_values(by="date")
+    first_calls_df.set_index("date", inplace=True)
+    first_calls_df["conversion"] = "First call"
+    logger.info(
+        f"Retrieved {len(first_calls_df)} first calls from Hubspot in {round(time.time() - start_time, 2)} seconds"
+    )
+
+    return first_calls_df
+
+
+def parse_first_calls(first_calls_df: pd.DataFrame) -> pd.DataFrame:
+    """Flatten the meeting search results and look up the contact emails."""
     first_calls_df = pd.concat(
         [first_calls_df, first_calls_df.properties.apply(pd.Series)], axis=1
     )
@@ -187,38 +261,9 @@ def get_first_calls():
     first_calls_df.hs_meeting_start_time = pd.to_datetime(
         first_calls_df.hs_meeting_start_time
     )
-    first_calls_df.set_index("date", inplace=True)
-    first_calls_df["conversion"] = "First call"
-    logger.info(
-        f"Retrieved {len(first_calls_df)} first calls from Hubspot in {round(time.time() - start_time, 2)} seconds"
-    )
-
     return first_calls_df
 
 
-def get_calendly_data(start_date: datetime.datetime):
-    logger.info("Retrieving calendly data")
-    start_time = time.time()
-    calendly_meetings = calendly.list_events(min_start_time=start_date)
-    calendly_meetings_df = pd.DataFrame(calendly_meetings)
-    first_calls_df = calendly_meetings_df.loc[
-        calendly_meetings_df.name.str.lower() == "first call with lalia"
-    ].set_index("created_at")
-    first_calls_df.index = pd.to_datetime(first_calls_df.index)
-    first_calls_df.sort_index(inplace=True)
-    first_calls_df["uuid"] = first_calls_df.uri.str.split("/").str[-1]
-    calendly_data = first_calls_df.uuid.apply(calendly.list_event_invitees).apply(
-        lambda x: pd.Series(x[0])
-    )
-    calendly_data = pd.concat(
-        [calendly_data, calendly_data.tracking.apply(pd.Series)], axis=1
-    ).drop(columns=["tracking"])
-    logger.info(
-        f"Retrieved {len(calendly_data)} meetings from calendly in {round(time.time() - start_time, 2)} seconds"
-    )
-    return calendly_data
-
-
 def get_first_call_verbal_agreements():
     if deals_df.empty:
         get_deals()
@@ -239,12 +284,64 @@ def get_placement_calls():
     return placement_deals
 
 
+def count_daily_conversions(
+    conversions: pd.DataFrame, group_columns: list[str]
+) -> pd.DataFrame:
+    """Count the conversions per day and group, with a column per conversion type.
+
+    Same result as `conversions.groupby(group_columns).resample("D").size()
+    .unstack("conversion").fillna(0)`, but counted in one pass over the floored dates
+    instead of one resampler per group. Like the resampler, the days between the first
+    and last conversion of a group are filled with zeros.
+
+    Args:
+        conversions (pd.DataFrame): Conversions with a datetime index named "date"
+        group_columns (list[str]): Columns to group by, including "conversion"
+
+    Returns:
+        pd.DataFrame: Counts indexed by the group columns (without "conversion") and date.
+    """
+    days = conversions.index.floor("D").rename("date")
+    counts = conversions.groupby([*group_columns, days]).size()
+    if counts.empty:
+        return counts.unstack("conversion")
+
+    # Fill the gaps between the first and last day of every group. The groups are
+    # sorted and contiguous and the days ascending within a group, so the full index
+    # is built from the index codes without comparing any labels.
+    index = counts.index
+    date_level = pd.date_range(days.min(), days.max(), freq="D", name="date")
+    day_numbers = date_level.get_indexer(index.levels[-1])[index.codes[-1]]
+    group_codes = np.column_stack(index.codes[:-1])
+    starts = np.flatnonzero(
+        np.r_[True, (group_codes[1:] != group_codes[:-1]).any(axis=1)]
+    )
+    ends = np.r_[starts[1:], len(counts)] - 1
+    lengths = day_numbers[ends] - day_numbers[starts] + 1
+    full_starts = np.cumsum(lengths) - lengths
+    # position of every day within its group
+    offsets = np.arange(lengths.sum()) - np.repeat(full_starts, lengths)
+    full_index = pd.MultiIndex(
+        levels=[*index.levels[:-1], date_level],
+        codes=[codes[np.repeat(starts, lengths)] for codes in index.codes[:-1]]
+        + [np.repeat(day_numbers[starts], lengths) + offsets],
+        names=index.names,
+        verify_integrity=False,
+    )
+    group_of_row = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    full_counts = np.zeros(len(full_index), dtype=counts.dtype)
+    full_counts[
+        full_starts[group_of_row] + day_numbers - day_numbers[starts][group_of_row]
+    ] = counts.to_numpy()
+    counts = pd.Series(full_counts, index=full_index)
+
+    return counts.unstack("conversion").fillna(0).sort_index()
+
+
 def get_hubspot_conversions(fetch_deals=True, filters=None):
     if filters:
         raise NotImplementedError("Filters are not yet implemented")
 
-    global calendly_data
-
     if fetch_deals:
         get_deals()
     first_calls_df = get_first_calls()
@@ -265,67 +362,23 @@ def get_hubspot_conversions(fetch_deals=True, filters=None):
         )
     )
 
-    # Check if we need to update calendly_data for newer conversions
+    # Update the attribution index if there are newer conversions
     if not conversions.empty:
-        latest_date = conversions.index.max()
-        # Convert both timestamps to naive for comparison
-        latest_date_naive = (
-            latest_date.tz_localize(None) if latest_date.tzinfo else latest_date
-        )
-        updated_at_naive = (
-            FIRST_CALL_DATA_UPDATED_AT.tz_localize(None)
-            if FIRST_CALL_DATA_UPDATED_AT.tzinfo
-            else FIRST_CALL_DATA_UPDATED_AT
-        )
-
-        if latest_date_naive > updated_at_naive:
-            logger.info(
-                f"Retrieving new calendly data since {FIRST_CALL_DATA_UPDATED_AT}"
-            )
-            new_calendly_data = get_calendly_data(FIRST_CALL_DATA_UPDATED_AT)
-            # Combine with existing calendly_data, preferring newer data if duplicates
-            calendly_data = pd.concat([calendly_data, new_calendly_data])
-            calendly_data = calendly_data[~calendly_data.index.duplicated(keep="last")]
-
-    # Prepare utm columns for merging
-    utm_columns = [
-        "utm_campaign",
-        "utm_source",
-        "utm_medium",
-        "utm_content",
-        "utm_term",
-    ]
+        attribution.update_index(conversions.index.max())
 
-    # Reset index of conversions to have date as a column
-    conversions_reset = conversions.reset_index()
+    utm_columns = attribution.UTM_COLUMNS
 
     # Enrich conversions with UTM data by joining on email
-    enriched_conversions = pd.merge(
-        conversions_reset,
-        calendly_data[utm_columns],
-        left_on="contact_email",
-        right_index=True,
-        how="left",
+    enriched_conversions = attribution.join_utm(
+        conversions.reset_index(), "contact_email"
     )
 
-    # Fill missing UTM values
-    for col in utm_columns:
-        if col in enriched_conversions.columns:
-            enriched_conversions[col] = enriched_conversions[col].fillna("unknown")
-        else:
-            enriched_conversions[col] = "unknown"
-
     group_columns = ["meeting_owner_name"] + utm_columns + ["conversion"]
 
     # Counts the number of conversions for each combination of date, UTM parameters, and conversion type and meeting owner
     # unstack("conversion") creates a column for each conversion type
     result = (
-        enriched_conversions.set_index("date")
-        .groupby(group_columns)
-        .resample("D")
-        .size()
-        .unstack("conversion")
-        .fillna(0)
+        count_daily_conversions(enriched_conversions.set_index("date"), group_columns)
         .reset_index()
         .set_index("date")
         .rename(
@@ -0,0 +1,42 @@
+"""
+Retry with exponential backoff for calls to rate limited APIs.
+"""
+
+import logging
+import random
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def call_with_retry(
+    func,
+    *args,
+    is_retryable=lambda e: True,
+    retries: int = 4,
+    backoff: float = 1.0,
+    **kwargs,
+):
+    """Call a function and retry it with exponential backoff and jitter if it fails.
+
+    Args:
+        func (callable): Function to call with *args and **kwargs
+        is_retryable (callable, optional): Returns whether an exception is transient. Defaults to retrying all exceptions.
+        retries (int, optional): Maximum number of retries. Defaults to 4.
+        backoff (float, optional): Delay before the first retry in seconds, doubled for every further retry. Defaults to 1.0.
+
+    Returns:
+        The return value of the function.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = backoff * 2**attempt + random.uniform(0, backoff)
+            logger.warning(
+                f"{func.__name__} failed ({e}), retrying in {round(delay, 2)} seconds"
+            )
+            time.sleep(delay)
@@ -1,3 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import logging
+import threading
+import time
+
 from data_sources import (
     ads_analytics,
     google_analytics,
@@ -5,36 +10,410 @@ from data_sources import (
     sales as sales_data,
 )
 import pandas as pd
-import panel as pn
+from partition_store import PartitionStore
+from single_flight import single_flight
 
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# persisted daily data, one partition per source and day
+DAILY_STORE = PartitionStore("./data/daily_store")
+
+# seconds after which the daily data is refreshed in the background
+DAILY_DATA_TTL = 3600
+
+# dimensions that are dictionary-encoded in the combined data
+DIMENSION_COLUMNS = [
+    "campaign",
+    "source",
+    "medium",
+    "content",
+    "term",
+    "landing_page",
+    "meeting_owner_name",
+]
+
+# persisted hourly data and its rollups, written at sync time so longer spans load a
+# few files of a coarser rollup instead of every hour
+# structure: {resolution: store}, hours and 4 hours per day, days per month
+HOURLY_STORES = {
+    "h": PartitionStore("./data/hourly/h", freq="D"),
+    "4h": PartitionStore("./data/hourly/4h", freq="D"),
+    "D": PartitionStore("./data/hourly/D", freq="MS"),
+}
+HOURLY_DATA_TTL = 3600
+# structure: [(maximum span, resolution)], longer spans are read per day
+HOURLY_RESOLUTIONS = [
+    (pd.Timedelta(days=7), "h"),
+    (pd.Timedelta(days=31), "4h"),
+]
+
+# last good combined daily data, swapped in by refresh_daily_data
+_daily_data = None
+# increased by every sync that changes the store
+_daily_data_version = 0
+_daily_data_lock = threading.Lock()
+_refreshing = False
+# status and time of the last daily store sync
+_source_status = {}
+_last_sync = 0.0
+_sync_lock = threading.Lock()
+_hourly_source_status = {}
+_last_hourly_sync = 0.0
+_hourly_sync_lock = threading.Lock()
+
+# structure: {source_name: (fetcher, timeout_in_seconds)}
+DAILY_SOURCES = {
+    "hubspot": (
+        lambda: hubspot_conversions.get_hubspot_conversions(filters=None),
+        300,
+    ),
+    "sales": (sales_data.get_sales_data, 120),
+    "facebook": (ads_analytics.get_facebook_ads_campaign_metrics, 300),
+    "google_ads": (ads_analytics.get_google_ads_campaign_metrics, 120),
+    "landing_page": (google_analytics.get_landing_page_report, 120),
+}
+
+# structure: {source_name: metric columns summed per hour, None counts the rows}
+HOURLY_METRICS = {
+    "first_calls": None,
+    "facebook": ["spend", "impressions", "clicks", "reach"],
+    "google_ads": ["spend", "impressions", "clicks", "conversions"],
+}
+
+HOURLY_SOURCES = {
+    "first_calls": (hubspot_conversions.get_first_calls, 300),
+    "facebook": (
+        lambda: ads_analytics.get_facebook_ads_campaign_metrics(
+            time_increment="hourly"
+        ),
+        300,
+    ),
+    "google_ads": (
+        lambda: ads_analytics.get_google_ads_campaign_metrics(hourly=True),
+        120,
+    ),
+}
+
+
+def fetch_sources(sources: dict) -> tuple[dict, dict]:
+    """Fetch all sources concurrently, each one bounded by its own timeout.
+
+    A source that fails or does not finish in time is left out of the results
+    instead of blocking the others.
+
+    Args:
+        sources (dict): {source_name: (fetcher, timeout_in_seconds)}
 
-@pn.cache(ttl=3600, to_disk=True)
-def get_daily_data() -> pd.DataFrame:
-    """Fetch all data sources and combine into a single dataframe with a datetime index.
     Returns:
-        pd.DataFrame: A dataframe with a datetime index.
-    """
-    hs = hubspot_conversions.get_hubspot_conversions(filters=None)
-    sales = sales_data.get_sales_data()
-    fb = ads_analytics.get_facebook_ads_campaign_metrics()
-    ga = ads_analytics.get_google_ads_campaign_metrics()
-    lp = google_analytics.get_landing_page_report()
-    data = pd.concat([hs, sales, fb, ga, lp]).infer_objects().convert_dtypes()
-    # Ensure index is datetime
+        tuple[dict, dict]: ({source_name: pd.DataFrame}, {source_name: status}) where
+            status is "ok", "timeout" or "error: <message>".
+    """
+    start_time = time.time()
+    results, status = {}, {}
+    executor = ThreadPoolExecutor(
+        max_workers=len(sources), thread_name_prefix="fetch_api"
+    )
+    futures = {name: executor.submit(fetcher) for name, (fetcher, _) in sources.items()}
+    try:
+        for name, future in futures.items():
+            timeout = sources[name][1]
+            remaining = max(0, start_time + timeout - time.time())
+            try:
+                results[name] = future.result(timeout=remaining)
+                status[name] = "ok"
+            except FutureTimeoutError:
+                logger.warning(f"Fetching {name} timed out after {timeout} seconds")
+                status[name] = "timeout"
+            except Exception as e:
+                logger.exception(f"Fetching {name} failed")
+                status[name] = f"error: {e}"
+    finally:
+        # don't wait for sources that timed out, their results are discarded
+        executor.shutdown(wait=False, cancel_futures=True)
+    logger.info(
+        f"Fetched {sum(s == 'ok' for s in status.values())}/{len(sources)} sources in {round(time.time() - start_time, 2)} seconds"
+    )
+    return results, status
+
+
+def sync_daily_store() -> dict:
+    """Fetch all data sources and write the new and changed days to the daily store.
+
+    Concurrent calls wait for the running sync and return its status instead of
+    starting another one.
+    Returns:
+        dict: {source_name: status}, see fetch_sources.
+    """
+    global _last_sync, _source_status, _daily_data_version
+    requested_at = time.time()
+    with _sync_lock:
+        if _last_sync >= requested_at:
+            return _source_status
+        results, status = fetch_sources(DAILY_SOURCES)
+        changed = False
+        for name, df in results.items():
+            written = DAILY_STORE.append(name, df.infer_objects().convert_dtypes())
+            logger.info(f"Wrote {written} new or changed days of {name} to the store")
+            changed = changed or written > 0
+        if changed:
+            _daily_data_version += 1
+        _source_status = status
+        _last_sync = time.time()
+        return status
+
+
+def ensure_daily_store():
+    """Make sure the daily store can be read without waiting for the data sources.
+
+    Syncs (blocking) only if nothing has been persisted yet. If the last sync is older
+    than DAILY_DATA_TTL, the data is refreshed in the background.
+    """
+    if not DAILY_STORE.sources():
+        sync_daily_store()
+    elif time.time() - _last_sync > DAILY_DATA_TTL:
+        refresh_daily_data_in_background()
+
+
+def encode_dimensions(data: pd.DataFrame) -> pd.DataFrame:
+    """Dictionary-encode the dimension columns as categoricals.
+
+    The categories of a column are its sorted values over all sources, so every source
+    shares the same codes and filters and groupbys compare integers instead of strings.
+    """
+    for col in DIMENSION_COLUMNS:
+        if col in data.columns:
+            data[col] = data[col].astype("string").astype("category")
+    return data
+
+
+def _read_store() -> pd.DataFrame:
+    data_version = _daily_data_version
+    data = DAILY_STORE.read(sources=list(DAILY_SOURCES))
+    data = encode_dimensions(data.infer_objects().convert_dtypes())
+    # Ensure index is datetime, the store returns the rows sorted by date
     data.index = pd.to_datetime(data.index)
+    data.attrs["source_status"] = dict(_source_status)
+    data.attrs["data_version"] = data_version
     return data
 
 
-@pn.cache(ttl=3600, to_disk=True)
-def get_hourly_data() -> pd.DataFrame:
-    """Fetch ads analytics and first call data and combine into a single dataframe with a datetime index. Might be useful for restoring lost tracking data.
+def refresh_daily_data():
+    """Sync the daily store and swap in the new combined daily data.
+
+    The store is only read again if the sync changed it.
+    """
+    global _daily_data
+    status = sync_daily_store()
+    with _daily_data_lock:
+        current = _daily_data
+        if (
+            current is not None
+            and current.attrs.get("data_version") == _daily_data_version
+        ):
+            current.attrs["source_status"] = dict(status)
+            logger.info(f"Daily data is up to date at version {_daily_data_version}")
+            return
+    data = _read_store()
+    with _daily_data_lock:
+        _daily_data = data
+    logger.info(f"Refreshed daily data to version {data.attrs['data_version']}")
+
+
+def refresh_daily_data_in_background():
+    """Refresh the daily data in a background thread, unless it's already refreshing."""
+    global _refreshing
+    with _daily_data_lock:
+        if _refreshing:
+            return
+        _refreshing = True
+
+    def refresh():
+        global _refreshing
+        try:
+            refresh_daily_data()
+        except Exception:
+            logger.exception("Refreshing daily data failed")
+        finally:
+            _refreshing = False
+
+    threading.Thread(target=refresh, name="refresh_daily_data", daemon=True).start()
+
+
+def daily_data_version() -> int:
+    """Version of the daily data served by get_daily_data.
+
+    It increases once the data of a sync that changed the store is swapped in, not
+    when the store is written. Cheap to compare, so it can be used to key caches of
+    results derived from the data.
+    """
+    with _daily_data_lock:
+        if _daily_data is None:
+            return _daily_data_version
+        return _daily_data.attrs["data_version"]
+
+
+@single_flight
+def get_daily_data() -> pd.DataFrame:
+    """Fetch all data sources and combine into a single dataframe with a datetime index.
+
+    Stale while revalidate: the last good data is returned immediately, if it's older
+    than DAILY_DATA_TTL it's refreshed in the background and swapped in once done.
     Returns:
-        pd.DataFrame: A dataframe with a datetime index.
+        pd.DataFrame: A dataframe with a datetime index, sorted by date.
     """
-    fc = hubspot_conversions.get_first_calls()
-    fb = ads_analytics.get_facebook_ads_campaign_metrics(time_increment="hourly")
-    ga = ads_analytics.get_google_ads_campaign_metrics(hourly=True)
-    data = pd.concat([fc, fb, ga]).infer_objects().convert_dtypes()
-    # Ensure index is datetime
-    data.index = pd.to_datetime(data.index)
+    global _daily_data
+    ensure_daily_store()
+    with _daily_data_lock:
+        if _daily_data is None:
+            _daily_data = _read_store()
+        return _daily_data
+
+
+def to_hourly_frame(df: pd.DataFrame, metrics: list[str] | None) -> pd.DataFrame:
+    """Sum the metrics (or count the rows) per hour and campaign, with compact dtypes.
+
+    Whole numbers (counts, clicks, ...) are stored as the smallest fitting integer
+    type, other metrics as float32 and campaigns as categories.
+    """
+    df = df.copy()
+    df.index = pd.to_datetime(df.index)
+    if df.index.tz is not None:
+        df.index = df.index.tz_localize(None)
+    keys = [df.index.floor("h").rename("date")]
+    if "campaign" in df.columns:
+        keys.append(df["campaign"].astype("string"))
+    if metrics is None:
+        hourly = df.groupby(keys, dropna=False).size().to_frame("count")
+    else:
+        columns = [m for m in metrics if m in df.columns]
+        hourly = df[columns].astype("float64").groupby(keys, dropna=False).sum()
+    if "campaign" in hourly.index.names:
+        hourly = hourly.reset_index("campaign")
+    for col in hourly.columns:
+        if col == "campaign":
+            hourly[col] = hourly[col].astype("category")
+        elif (hourly[col] % 1 == 0).all():
+            hourly[col] = pd.to_numeric(hourly[col], downcast="integer")
+        else:
+            hourly[col] = hourly[col].astype("float32")
+    return hourly
+
+
+def sync_hourly_store() -> dict:
+    """Fetch the hourly sources and write their new or changed hours and rollups to
+    the stores.
+
+    Returns:
+        dict: {source_name: status}, see fetch_sources.
+    """
+    global _last_hourly_sync, _hourly_source_status
+    requested_at = time.time()
+    with _hourly_sync_lock:
+        if _last_hourly_sync >= requested_at:
+            return _hourly_source_status
+        results, status = fetch_sources(HOURLY_SOURCES)
+        hour_store = HOURLY_STORES["h"]
+        for name, df in results.items():
+            hourly = to_hourly_frame(df, HOURLY_METRICS[name])
+            if hourly.empty:
+                continue
+            written = hour_store.upsert(name, hourly)
+            logger.info(
+                f"Wrote {written} new or changed partitions of {name} (h) to the store"
+            )
+            # rollup partitions are rebuilt from all their stored hours, the fetched
+            # hours may cover only part of a day or month
+            for resolution, store in HOURLY_STORES.items():
+                if resolution == "h":
+                    continue
+                first, last = store.period_bounds(
+                    hourly.index.min(), hourly.index.max()
+                )
+                hours = hour_store.read(first, last, sources=[name])
+                written = store.append(name, downsample(hours, resolution))
+                logger.info(
+                    f"Wrote {written} new or changed partitions of {name} ({resolution}) to the store"
+                )
+        _hourly_source_status = status
+        _last_hourly_sync = time.time()
+        return status
+
+
+def ensure_hourly_store():
+    """Sync the hourly store if nothing has been persisted yet (blocking) or if the
+    last sync is older than HOURLY_DATA_TTL (in the background)."""
+    if not HOURLY_STORES["h"].sources():
+        sync_hourly_store()
+    elif time.time() - _last_hourly_sync > HOURLY_DATA_TTL:
+        if not _hourly_sync_lock.locked():
+            threading.Thread(
+                target=sync_hourly_store, name="sync_hourly_store", daemon=True
+            ).start()
+
+
+def hourly_resolution(span: pd.Timedelta) -> str:
+    """Resolution at which a span of hourly data is read, see HOURLY_RESOLUTIONS."""
+    for max_span, resolution in HOURLY_RESOLUTIONS:
+        if span <= max_span:
+            return resolution
+    return "D"
+
+
+def downsample(data: pd.DataFrame, resolution: str) -> pd.DataFrame:
+    """Sum the hourly rows per period of the resolution (and campaign)."""
+    keys = [data.index.floor(resolution).rename("date")]
+    if "campaign" in data.columns:
+        keys.append(data["campaign"])
+    metrics = data.columns.drop("campaign", errors="ignore")
+    downsampled = (
+        data[metrics].groupby(keys, dropna=False, observed=True).sum(min_count=1)
+    )
+    if "campaign" in downsampled.index.names:
+        downsampled = downsampled.reset_index("campaign")
+    return downsampled
+
+
+def get_hourly_data(
+    start=None, end=None, resolution: str | None = None
+) -> pd.DataFrame:
+    """Read ads analytics and first call data between start and end (inclusive) from the hourly store. Might be useful for restoring lost tracking data.
+
+    Longer spans are read from the coarser rollups (hour -> 4 hours -> day), see
+    HOURLY_RESOLUTIONS. Only the partitions overlapping the range are loaded, and rows
+    of a rollup cover their whole period, so the range is widened to whole periods.
+
+    Args:
+        start (optional): Start of the range. Defaults to the first stored hour.
+        end (optional): End of the range. Defaults to the last stored hour.
+        resolution (str | None, optional): "h", "4h" or "D", overrides the resolution
+            chosen by the span. Other resolutions are downsampled from the hours.
+            Defaults to None.
+
+    Returns:
+        pd.DataFrame: A dataframe with a datetime index, one row per period and campaign.
+    """
+    ensure_hourly_store()
+    stored_sources = HOURLY_STORES["h"].sources()
+    sources = [name for name in HOURLY_SOURCES if name in stored_sources]
+    if not sources:
+        return pd.DataFrame()
+    if resolution is None:
+        # bounds of the day partitions, the last day is stored up to its end
+        first, last = HOURLY_STORES["h"].bounds(sources)
+        span = pd.Timestamp(end or last + pd.Timedelta(days=1)) - pd.Timestamp(
+            start or first
+        )
+        resolution = hourly_resolution(span)
+    if resolution in HOURLY_STORES:
+        if start is not None:
+            start = pd.Timestamp(start).floor(resolution)
+        data = HOURLY_STORES[resolution].read(start, end, sources=sources)
+    else:
+        data = HOURLY_STORES["h"].read(start, end, sources=sources)
+    if data.empty:
+        return data
+    data = encode_dimensions(data)
+    if resolution not in HOURLY_STORES:
+        data = downsample(data, resolution)
     return data
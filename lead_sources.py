@@ -3,18 +3,32 @@ import panel as pn
 
 from data_sources import ads_analytics, google_analytics, hubspot_conversions, sales
 import fetch_api
+import metric_cube
+from simple_cache import TimedLRUCache
 
 # --- Configuration ---
 pn.extension("tabulator", "indicators", design="material")
 
 
 # --- Data Loading ---
-@pn.cache(ttl=3600)  # Cache the processed data for an hour
-def load_and_prepare_data():
-    """Loads data using fetch_api and performs initial preparation."""
-    df = fetch_api.get_daily_data()
-    # Ensure index is datetime
-    df.index = pd.to_datetime(df.index)
+# Prepared cubes and computed metrics are keyed by the data version, so a refresh of
+# the store invalidates them
+PREPARED_DATA = TimedLRUCache(seconds=float("inf"), max_entries=4)
+METRICS_CACHE = TimedLRUCache(seconds=float("inf"), max_entries=256)
+
+
+def load_and_prepare_data(data):
+    """Loads the metric cube of the daily data and performs initial preparation.
+
+    The cube holds the daily sums per campaign and UTM parameters, so the metrics are
+    computed from its cells instead of the raw rows. It's prepared once per data
+    version (`data.attrs["data_version"]`).
+    """
+    data_version = data.attrs["data_version"]
+    found, df = PREPARED_DATA.get(data_version)
+    if found:
+        return df
+    df = metric_cube.get_cube(data).copy()
 
     # Add platform column
     def get_platform(src):
@@ -28,35 +42,42 @@ def load_and_prepare_data():
 
     df["platform"] = df["source"].apply(get_platform)
 
-    # Fill NA for cost and potential lead columns for easier aggregation
-    df["cost"] = df["cost"].fillna(0)
-    # Assuming 'landing_page' itself indicates a visit if present from GA source?
-    # For simplicity, let's assume non-null indicates the conversion event happened.
-    df["landing_page_lead"] = ~df["landing_page"].isnull()
-    df["first_call_lead"] = ~df["first_call"].isnull()
-    df["sales_lead"] = ~df["sales"].isnull()
+    # Fill NA for cost and lead columns for easier aggregation
+    metric_columns = ["spend", *CONVERSION_MAP.values()]
+    df[metric_columns] = df.reindex(columns=metric_columns).fillna(0)
 
     # Use campaign name, fill missing ones
-    df["campaign"] = df["campaign"].fillna("Unknown")
+    campaign = df["campaign"].astype("category")
+    if "Unknown" not in campaign.cat.categories:
+        campaign = campaign.cat.add_categories("Unknown")
+    df["campaign"] = campaign.fillna("Unknown")
 
+    df.attrs["data_version"] = data_version
+    PREPARED_DATA.set(data_version, df)
     return df
 
 
-raw_data = load_and_prepare_data()
+fetch_api.ensure_daily_store()
 
 # --- Constants ---
 CONVERSION_MAP = {
-    "Landing Page Visit": "landing_page_lead",
-    "First Call": "first_call_lead",
-    "Sale": "sales_lead",
+    "Landing Page Visit": "sessions",
+    "First Call": "first_call",
+    "Sale": "sales",
 }
 DEFAULT_CONVERSION = "First Call"
 # Add a small epsilon to avoid division by zero
 EPSILON = 1e-9
 
 # --- Widgets ---
-min_date = raw_data.index.min().date()
-max_date = raw_data.index.max().date()
+# the date bounds are read from the store manifests, without loading any data. Nothing
+# is stored yet if every source failed on the first sync, then the last 90 days are
+# offered
+first_date, last_date = fetch_api.DAILY_STORE.bounds(list(fetch_api.DAILY_SOURCES))
+if first_date is None:
+    last_date = pd.Timestamp.today().normalize()
+    first_date = last_date - pd.Timedelta(days=90)
+min_date, max_date = first_date.date(), last_date.date()
 
 date_range_slider = pn.widgets.DateRangeSlider(
     name="Date Range",
@@ -74,24 +95,42 @@ conversion_select = pn.widgets.Select(
 
 
 # --- Reactive Data Processing ---
-@pn.cache  # Cache results based on widget values
-def process_metrics(data, date_range, conversion_type, group_by_col):
-    """Filters data and calculates metrics based on selected filters and grouping."""
+def process_metrics(date_range, conversion_type, group_by_col):
+    """Calculates metrics based on selected filters and grouping.
+
+    Results are cached by the data version and the filter values, so a cache lookup
+    doesn't depend on the size of the data.
+    """
     start_date, end_date = date_range
+    # The version is taken from the same frame the metrics are computed from
+    prepared_data = load_and_prepare_data(fetch_api.get_daily_data())
     # Ensure comparison is between datetime objects
-    mask = (data.index >= pd.to_datetime(start_date)) & (
-        data.index <= pd.to_datetime(end_date)
+    key = (
+        prepared_data.attrs["data_version"],
+        pd.to_datetime(start_date),
+        pd.to_datetime(end_date),
+        conversion_type,
+        group_by_col,
     )
-    filtered_data = data[mask]
+    found, metrics = METRICS_CACHE.get(key)
+    if not found:
+        metrics = compute_metrics(prepared_data, *key[1:])
+        METRICS_CACHE.set(key, metrics)
+    return metrics
+
+
+def compute_metrics(prepared_data, start_date, end_date, conversion_type, group_by_col):
+    """Calculates the metrics of the date range from the prepared cube."""
+    # the cube is sorted by date, so the range is a slice found by binary search
+    filtered_data = metric_cube.date_slice(prepared_data, start_date, end_date)
 
     lead_col = CONVERSION_MAP[conversion_type]
 
     # Calculate Costs per group
-    total_costs = filtered_data.groupby(group_by_col)["cost"].sum()
+    total_costs = filtered_data.groupby(group_by_col)["spend"].sum()
 
     # Calculate Leads per group
-    leads_data = filtered_data[filtered_data[lead_col] == True]
-    total_leads = leads_data.groupby(group_by_col).size()
+    total_leads = filtered_data.groupby(group_by_col)[lead_col].sum()
 
     # Combine metrics
     metrics = pd.DataFrame(
@@ -150,7 +189,6 @@ def create_plots(metrics_df):
 # Bind processing function to widgets for campaign and platform levels
 campaign_metrics = pn.bind(
     process_metrics,
-    data=raw_data,
     date_range=date_range_slider,
     conversion_type=conversion_select,
     group_by_col="campaign",
@@ -158,7 +196,6 @@ campaign_metrics = pn.bind(
 
 platform_metrics = pn.bind(
     process_metrics,
-    data=raw_data,
     date_range=date_range_slider,
     conversion_type=conversion_select,
     group_by_col="platform",
@@ -0,0 +1,344 @@
+"""
+Pre-aggregated metric cube of the combined daily data.
+
+The cube holds the daily sums of the key metrics per (campaign, source, medium,
+content, term) and is built once per data version. Weekly and monthly rollups are
+derived from the daily cube, so panel queries aggregate cube cells instead of
+scanning the raw rows of every source.
+"""
+
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from simple_cache import TimedLRUCache
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CUBE_DIMENSIONS = ["campaign", "source", "medium", "content", "term"]
+CUBE_METRICS = [
+    "spend",
+    "clicks",
+    "sessions",
+    "first_call",
+    "verbal_agreement_after_first_call",
+    "placement_scheduled",
+    "sales",
+]
+# structure: {time_agg: period frequency}
+ROLLUP_FREQUENCIES = {
+    "weekly": "W",
+    "monthly": "M",
+}
+# structure: {time_agg: frequency of the period starts}
+PERIOD_START_FREQUENCIES = {
+    "daily": "D",
+    "weekly": "7D",
+    "monthly": "MS",
+}
+
+# Cubes are keyed by data version, so they never expire, they're only evicted
+_cubes = TimedLRUCache(seconds=float("inf"), max_entries=4)
+# Inverted indexes of the daily cubes, keyed by data version
+_indexes = TimedLRUCache(seconds=float("inf"), max_entries=4)
+
+
+def build_cube(data: pd.DataFrame) -> pd.DataFrame:
+    """Aggregate the raw rows to daily sums of the metrics per dimension combination.
+
+    Missing dimension values are kept as their own group. A metric of a cell is NA if
+    none of its rows has a value, like in the raw data.
+
+    Returns:
+        pd.DataFrame: The dimension and metric columns with the day as datetime index.
+    """
+    start_time = time.time()
+    metrics = [m for m in CUBE_METRICS if m in data.columns]
+    frame = data.reindex(columns=CUBE_DIMENSIONS + metrics)
+    frame[metrics] = frame[metrics].astype("float64")
+    date = pd.DatetimeIndex(data.index).normalize().rename("date")
+    cube = (
+        frame.groupby([date] + CUBE_DIMENSIONS, dropna=False, observed=True)[metrics]
+        .sum(min_count=1)
+        .reset_index(level=CUBE_DIMENSIONS)
+    )
+    logger.info(
+        f"Built metric cube of {len(cube)} cells from {len(data)} rows in {round(time.time() - start_time, 2)} seconds"
+    )
+    return cube
+
+
+def rollup(cube: pd.DataFrame, time_agg: str) -> pd.DataFrame:
+    """Roll the daily cube up to "weekly" or "monthly" cells, indexed by the start of
+    the period. "daily" returns the cube as is."""
+    if time_agg == "daily":
+        return cube
+    metrics = [m for m in CUBE_METRICS if m in cube.columns]
+    period = cube.index.to_period(ROLLUP_FREQUENCIES[time_agg]).start_time
+    return (
+        cube.groupby(
+            [period.rename("date")] + CUBE_DIMENSIONS, dropna=False, observed=True
+        )[metrics]
+        .sum(min_count=1)
+        .reset_index(level=CUBE_DIMENSIONS)
+    )
+
+
+def densify(aggregated: pd.Series | pd.DataFrame, time_agg: str = "daily"):
+    """Fill the periods without cells between the first and last period with zeros.
+
+    Cells only exist for periods with data, so charts that need a continuous time
+    axis densify their aggregated series on demand.
+
+    Args:
+        aggregated (pd.Series | pd.DataFrame): Values indexed by period start
+        time_agg (str, optional): "daily", "weekly" or "monthly". Defaults to "daily".
+    """
+    if aggregated.empty:
+        return aggregated
+    periods = pd.date_range(
+        aggregated.index.min(),
+        aggregated.index.max(),
+        freq=PERIOD_START_FREQUENCIES[time_agg],
+        name=aggregated.index.name,
+    )
+    return aggregated.reindex(periods, fill_value=0)
+
+
+def pivot_top_values(
+    cells: pd.DataFrame,
+    dimension: str,
+    metrics: list[str],
+    top_n: int,
+    rank_by: list[str] | None = None,
+) -> pd.DataFrame:
+    """Sums of the metrics per period and value of the dimension, in one pivot.
+
+    Only the top_n values by their total get their own series, the other values are
+    summed up as "Other". Cells without a value of the dimension are left out.
+
+    The values are ranked by the first metric of rank_by with a non-zero total on the
+    dimension, metrics of other sources (e.g. spend per source) have no totals there.
+    Without any, they are ranked by the sum over the metrics.
+
+    Args:
+        cells (pd.DataFrame): Cube cells indexed by period start
+        dimension (str): Dimension to compare, e.g. "campaign"
+        metrics (list[str]): Metrics to sum
+        top_n (int): Number of values with their own series
+        rank_by (list[str], optional): Metrics to rank the values by, in order of
+            preference. Defaults to the metrics.
+
+    Returns:
+        pd.DataFrame: Indexed by period start with (metric, value) columns, the top
+            values by rank and "Other" last. Periods without cells of a value are NA.
+    """
+    values = cells[dimension]
+    rank_by = rank_by or metrics
+    metric_totals = cells.groupby(dimension, observed=True)[
+        list(dict.fromkeys([*rank_by, *metrics]))
+    ].sum()
+    ranked = [metric for metric in rank_by if metric_totals[metric].any()]
+    totals = metric_totals[ranked[0]] if ranked else metric_totals[metrics].sum(axis=1)
+    top = totals.sort_values(ascending=False, kind="stable").index[:top_n]
+    labels = np.where(isin(values, list(top)), values.astype(object), "Other")
+    labels = pd.Index(labels, name=dimension).where(values.notna().to_numpy())
+
+    pivot = (
+        cells[metrics]
+        .groupby([cells.index.rename("time_period"), labels])
+        .sum()
+        .unstack(dimension)
+    )
+    order = list(top) + (["Other"] if len(totals) > top_n else [])
+    return pivot.reindex(columns=pd.MultiIndex.from_product([metrics, order]))
+
+
+def isin(column: pd.Series, values: list) -> pd.Series:
+    """Boolean mask of the rows whose value is one of the values.
+
+    For categorical columns the mask is looked up by integer code in a table over the
+    categories, without comparing any strings per row.
+    """
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        return column.isin(values)
+    codes = column.cat.categories.get_indexer(values)
+    # one extra entry for the code -1 of missing values
+    table = np.zeros(len(column.cat.categories) + 1, dtype=bool)
+    table[codes[codes >= 0]] = True
+    return pd.Series(table[column.cat.codes.to_numpy()], index=column.index)
+
+
+def build_index(cube: pd.DataFrame) -> dict:
+    """Inverted index of the cube: the row positions of every value per dimension.
+
+    Returns:
+        dict: structure: {dimension: {value: sorted np.ndarray of row positions}}.
+            Missing values aren't indexed.
+    """
+    start_time = time.time()
+    index = {}
+    for dimension in CUBE_DIMENSIONS:
+        if dimension not in cube.columns:
+            continue
+        codes, values = pd.factorize(cube[dimension])
+        # a stable sort keeps the rows of every value in ascending order
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+        index[dimension] = {
+            value: order[bounds[i] : bounds[i + 1]] for i, value in enumerate(values)
+        }
+    logger.info(
+        f"Built inverted index of {len(cube)} cube cells in {round(time.time() - start_time, 2)} seconds"
+    )
+    return index
+
+
+def get_index(cube: pd.DataFrame) -> dict:
+    """Inverted index of the cube, built once per data version and time aggregation of
+    the cubes from get_cube."""
+    data_version = cube.attrs.get("data_version")
+    if data_version is None:
+        return build_index(cube)
+    key = (data_version, cube.attrs.get("time_agg"))
+    found, index = _indexes.get(key)
+    if not found:
+        index = build_index(cube)
+        _indexes.set(key, index)
+    return index
+
+
+def date_bounds(index: pd.DatetimeIndex, start=None, end=None) -> tuple[int, int]:
+    """Positions of the first row from start and the row after the last one up to end
+    of a sorted datetime index, found by binary search."""
+    first, last = 0, len(index)
+    if start is not None:
+        first = index.searchsorted(pd.Timestamp(start), side="left")
+    if end is not None:
+        last = index.searchsorted(pd.Timestamp(end), side="right")
+    return first, last
+
+
+def date_slice(frame: pd.DataFrame, start=None, end=None) -> pd.DataFrame:
+    """Rows of the frame between start and end (inclusive).
+
+    For a frame sorted by date, like the daily data and the cubes, the rows are a
+    slice found by binary search, returned as a view without copying. Unsorted frames
+    are filtered by a mask.
+    """
+    if not frame.index.is_monotonic_increasing:
+        mask = np.ones(len(frame), dtype=bool)
+        if start is not None:
+            mask &= frame.index >= pd.Timestamp(start)
+        if end is not None:
+            mask &= frame.index <= pd.Timestamp(end)
+        return frame[mask]
+    first, last = date_bounds(frame.index, start, end)
+    return frame.iloc[first:last]
+
+
+def union_rows(postings: list, start: int, end: int) -> np.ndarray:
+    """Sorted union of the disjoint, sorted row positions of several values.
+
+    Sparse unions are merged by sorting, dense ones through a bitmap of the rows from
+    start to end.
+    """
+    if not postings:
+        return np.array([], dtype=np.intp)
+    if len(postings) == 1:
+        return postings[0]
+    if sum(len(rows) for rows in postings) * 8 < end - start:
+        return np.sort(np.concatenate(postings))
+    bitmap = np.zeros(end - start, dtype=bool)
+    for rows in postings:
+        bitmap[rows - start] = True
+    return np.flatnonzero(bitmap) + start
+
+
+def query(
+    cube: pd.DataFrame, filters: dict, date_range: tuple | None = None
+) -> pd.DataFrame:
+    """Cells of the cube in the date range that match all filters.
+
+    The date range is found by binary search on the sorted dates. The most selective
+    filter on an indexed dimension selects the candidate cells from the inverted
+    index, all other filters are only checked on these candidates. So the cost scales
+    with the matching cells instead of all cells.
+
+    Args:
+        cube (pd.DataFrame): Daily cube from get_cube
+        filters (dict): structure: {column: [values] | (start, end) | value}. Empty
+            filters and columns the cube doesn't have are ignored.
+        date_range (tuple, optional): (start, end) of the days, both included.
+    """
+    index = get_index(cube)
+    start, end = 0, len(cube)
+    remaining = {}
+    if date_range is not None:
+        if cube.index.is_monotonic_increasing:
+            start, end = date_bounds(cube.index, *date_range)
+        else:
+            remaining[None] = date_range
+
+    # structure: {column: [row positions of every selected value within the range]}
+    postings = {}
+    for column, value in filters.items():
+        if column not in cube.columns or not value:
+            continue
+        if column in index and isinstance(value, (list, str)):
+            values = value if isinstance(value, list) else [value]
+            postings[column] = []
+            for rows in (index[column][v] for v in values if v in index[column]):
+                # the positions are sorted, so the range is a slice
+                postings[column].append(
+                    rows[np.searchsorted(rows, start) : np.searchsorted(rows, end)]
+                )
+        else:
+            remaining[column] = value
+
+    if postings:
+        selective = min(postings, key=lambda c: sum(len(rows) for rows in postings[c]))
+        selected = cube.iloc[union_rows(postings.pop(selective), start, end)]
+        remaining.update({column: filters[column] for column in postings})
+    else:
+        selected = cube.iloc[start:end]
+
+    for column, value in remaining.items():
+        values = selected.index if column is None else selected[column]
+        if isinstance(value, list):
+            mask = isin(values, value)
+        elif isinstance(value, tuple) and len(value) == 2:
+            mask = (values >= pd.Timestamp(value[0])) & (
+                values <= pd.Timestamp(value[1])
+            )
+        else:
+            mask = values == value
+        selected = selected[np.asarray(mask)]
+    return selected
+
+
+def get_cube(data: pd.DataFrame, time_agg: str = "daily") -> pd.DataFrame:
+    """Cube of the daily data, built once per data version (`data.attrs["data_version"]`).
+
+    Args:
+        data (pd.DataFrame): Combined daily data, e.g. from fetch_api.get_daily_data()
+        time_agg (str, optional): "daily", "weekly" or "monthly". Defaults to "daily".
+    """
+    data_version = data.attrs.get("data_version")
+    if data_version is None:
+        return rollup(build_cube(data), time_agg)
+
+    key = (data_version, time_agg)
+    found, cube = _cubes.get(key)
+    if not found:
+        if time_agg == "daily":
+            cube = build_cube(data)
+        else:
+            cube = rollup(get_cube(data), time_agg)
+        cube.attrs["data_version"] = data_version
+        cube.attrs["time_agg"] = time_agg
+        _cubes.set(key, cube)
+    return cube
@@ -1,10 +1,15 @@
+import json
+
 import panel as pn
-import plotly.express as px
+import plotly.colors as plotly_colors  # lighter than importing plotly.express
 import plotly.graph_objects as go
 import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 
+import metric_cube
+from simple_cache import TimedLRUCache, make_key
+
 
 KEY_METRICS = {
     "spend": "Ad spend",
@@ -38,6 +43,15 @@ KEY_METRIC_FILTERS = {
     "boolean": {},
 }
 
+# Built charts shared by all sessions, keyed by data version and normalized widget state
+# structure: {key: ("plotly", figure_json) | ("markdown", text)}
+FIGURE_CACHE = TimedLRUCache(
+    seconds=float("inf"), max_entries=64, max_bytes=64 * 1024**2
+)
+
+# Values of the compared dimension with their own series, the rest is shown as "Other"
+COMPARISON_TOP_N = 10
+
 # structure: {filter_type: {filter_name: filter_label}}
 KEY_METRIC_COMPARISON_OPTIONS = {
     "button_group": {
@@ -54,6 +68,9 @@ KEY_METRIC_COMPARISON_OPTIONS = {
 
 
 def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
+    # The chart queries the cells of the metric cube instead of the raw rows
+    cube = metric_cube.get_cube(data)
+
     # Create widgets for filters and comparisons
     date_range = pn.widgets.DateRangeSlider(
         name="Date Range",
@@ -81,8 +98,8 @@ def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
         for key, (name, _) in filter_options.items():
             if filter_type == "multi_choice":
                 options = []
-                if key in data.columns:
-                    options = list(data[key].dropna().unique())
+                if key in cube.columns:
+                    options = list(cube[key].dropna().unique())
                 local_filters[key] = pn.widgets.MultiChoice(
                     name=name,
                     options=options,
@@ -161,36 +178,13 @@ def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
         comparison_date_ranges,
         show_relative=False,
         show_trend=False,
+        rank_by=None,
     ):
-        # Filter data by date range
-        filtered_data = data[
-            (data.index >= pd.Timestamp(date_range[0]))
-            & (data.index <= pd.Timestamp(date_range[1]))
-        ]
-
-        # Apply local filters
-        for filter_name, filter_value in local_filters.items():
-            if filter_name in filtered_data.columns and filter_value:
-                if isinstance(filter_value, list):  # MultiChoice filters
-                    if filter_value:  # Only filter if values are selected
-                        filtered_data = filtered_data[
-                            filtered_data[filter_name].isin(filter_value)
-                        ]
-                elif (
-                    isinstance(filter_value, tuple) and len(filter_value) == 2
-                ):  # DateRange
-                    filtered_data = filtered_data[
-                        (filtered_data[filter_name] >= pd.Timestamp(filter_value[0]))
-                        & (filtered_data[filter_name] <= pd.Timestamp(filter_value[1]))
-                    ]
-                elif isinstance(filter_value, bool):  # Boolean
-                    filtered_data = filtered_data[
-                        filtered_data[filter_name] == filter_value
-                    ]
-                else:  # Single value filters
-                    filtered_data = filtered_data[
-                        filtered_data[filter_name] == filter_value
-                    ]
+        # the compared values are ranked by the metrics in the order they were selected
+        rank_by = rank_by or selected_metrics
+        # Select the cells of the date range and the local filters, the filters on
+        # the dimensions are answered from the inverted index of the cube
+        filtered_data = metric_cube.query(data, local_filters, date_range)
 
         # drop rows where all metrics are 0
         metrics_to_check = [m for m in selected_metrics if m in filtered_data.columns]
@@ -214,13 +208,9 @@ def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
                     "No non-zero data available for the selected metrics and filters"
                 )
 
-        # Aggregate by time
-        if time_agg == "daily":
-            filtered_data["time_period"] = filtered_data.index
-        elif time_agg == "weekly":
-            filtered_data["time_period"] = filtered_data.index.to_period("W").start_time
-        elif time_agg == "monthly":
-            filtered_data["time_period"] = filtered_data.index.to_period("M").start_time
+        # Aggregate by time, the daily cube cells are rolled up to the time periods
+        filtered_data = metric_cube.rollup(filtered_data, time_agg)
+        filtered_data["time_period"] = filtered_data.index
 
         # Prepare data for plotting
         if not selected_metrics:
@@ -237,32 +227,28 @@ def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
                     0
                 ]  # Use the first selected dimension
 
-                for metric in selected_metrics:
-                    # Group by time period and the comparison dimension
-                    comparison_data = (
-                        filtered_data.groupby(["time_period", comparison_dim])[metric]
-                        .sum()
-                        .reset_index()
-                    )
-
-                    # Get unique values for the comparison dimension
-                    unique_values = comparison_data[comparison_dim].unique()
-
-                    # Create a line for each unique value
-                    for value in unique_values:
-                        value_data = comparison_data[
-                            comparison_data[comparison_dim] == value
-                        ]
-                        if not value_data.empty:
-                            fig.add_trace(
-                                go.Scatter(
-                                    x=value_data["time_period"],
-                                    y=value_data[metric],
-                                    mode="lines+markers",
-                                    name=f"{KEY_METRICS.get(metric, metric)} - {value}",
-                                    hovertemplate="%{y:.2f}",
-                                )
+                # All series come from one pivot, only the top values by the first
+                # selected metric with totals on the dimension get their own series,
+                # the others are "Other"
+                comparison_data = metric_cube.pivot_top_values(
+                    filtered_data,
+                    comparison_dim,
+                    selected_metrics,
+                    COMPARISON_TOP_N,
+                    rank_by=[m for m in rank_by if m in selected_metrics],
+                )
+                for metric, value in comparison_data.columns:
+                    value_data = comparison_data[(metric, value)].dropna()
+                    if not value_data.empty:
+                        fig.add_trace(
+                            go.Scatter(
+                                x=value_data.index,
+                                y=value_data.to_numpy(),
+                                mode="lines+markers",
+                                name=f"{KEY_METRICS.get(metric, metric)} - {value}",
+                                hovertemplate="%{y:.2f}",
                             )
+                        )
 
             # Handle date range comparison
             elif comparison_date_ranges:
@@ -285,10 +271,7 @@ def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
                 # Then plot each comparison date range
                 for i, comp_range in enumerate(comparison_date_ranges):
                     # Get data for the comparison range
-                    comp_data = data[
-                        (data.index >= pd.Timestamp(comp_range[0]))
-                        & (data.index <= pd.Timestamp(comp_range[1]))
-                    ].copy()
+                    comp_data = metric_cube.date_slice(data, *comp_range).copy()
 
                     # Apply the same time aggregation
                     if time_agg == "daily":
@@ -343,7 +326,9 @@ def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
             # Add trend lines if requested
             if show_trend:
                 # Define a color palette
-                colors = px.colors.qualitative.Plotly  # Plotly's default color sequence
+                colors = (
+                    plotly_colors.qualitative.Plotly
+                )  # Plotly's default color sequence
 
                 # Keep track of which series we've seen
                 color_mapping = {}
@@ -430,9 +415,12 @@ def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
             plot_data = []
 
             for metric in selected_metrics:
-                metric_data = (
-                    filtered_data.groupby("time_period")[metric].sum().reset_index()
-                )
+                metric_data = filtered_data.groupby("time_period")[metric].sum()
+                if show_trend:
+                    # trend lines are fitted over the period number, so periods
+                    # without data must be zeros instead of gaps
+                    metric_data = metric_cube.densify(metric_data, time_agg)
+                metric_data = metric_data.reset_index()
                 metric_data["series"] = KEY_METRICS.get(metric, metric)
                 plot_data.append(metric_data)
 
@@ -506,7 +494,7 @@ def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
                 if show_trend:
                     # Define a color palette
                     colors = (
-                        px.colors.qualitative.Plotly
+                        plotly_colors.qualitative.Plotly
                     )  # Plotly's default color sequence
 
                     # Keep track of which series we've seen
@@ -632,20 +620,61 @@ def key_metrics_panel(data: pd.DataFrame, global_filter_widgets: dict):
         show_relative_val = args[-2]
         show_trend_val = args[-1]
 
+        # Normalize the widget state, so equal views share one cache entry: whole
+        # days, metrics in KEY_METRICS order, no empty and sorted filter values
+        date_range_val = (
+            pd.Timestamp(date_range_val[0]).ceil("D"),
+            pd.Timestamp(date_range_val[1]).floor("D"),
+        )
+        selected_metrics = [k for k, v in KEY_METRICS.items() if v in key_metrics_val]
+        # the selection order only matters for ranking the compared values
+        metric_keys = {v: k for k, v in KEY_METRICS.items()}
+        rank_by = [metric_keys[v] for v in key_metrics_val if v in metric_keys]
+        local_filter_values = {
+            name: sorted(value, key=str) if isinstance(value, list) else value
+            for name, value in local_filter_values.items()
+            if value
+        }
+        key = (
+            cube.attrs.get("data_version"),
+            pn.config.theme,
+            make_key(date_range_val),
+            time_agg_val,
+            make_key(selected_metrics),
+            make_key(rank_by if comparison_dimensions else None),
+            make_key(local_filter_values),
+            make_key(comparison_dimensions),
+            make_key(comparison_date_ranges),
+            show_relative_val,
+            show_trend_val,
+        )
+        found, cached = FIGURE_CACHE.get(key)
+        if found:
+            kind, content = cached
+            if kind == "plotly":
+                return pn.pane.Plotly(json.loads(content), sizing_mode="stretch_both")
+            return pn.pane.Markdown(content)
+
         # Create the plot
-        swap = lambda x: {v: k for k, v in x.items()}
         plot = create_key_metrics_plot(
-            data,
+            cube,
             date_range_val,
             time_agg_val,
-            [swap(KEY_METRICS)[k] for k in key_metrics_val],
+            selected_metrics,
             local_filter_values,
             comparison_dimensions,
             comparison_date_ranges,
             show_relative=show_relative_val,
             show_trend=show_trend_val,
+            rank_by=rank_by,
         )
 
+        # Figures are cached as JSON, every session gets its own copy to interact with
+        if key[0] is not None:
+            if isinstance(plot, pn.pane.Plotly):
+                FIGURE_CACHE.set(key, ("plotly", plot.object.to_json()))
+            else:
+                FIGURE_CACHE.set(key, ("markdown", plot.object))
         return plot
 
     # Chart with collapsible sidebar for settings
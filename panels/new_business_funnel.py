@@ -1,7 +1,11 @@
 import plotly.graph_objects as go
 import pandas as pd
+import numpy as np
 import colorsys
-from collections import defaultdict
+import logging
+import os
+import threading
+import time
 import panel as pn
 from hubspot_conversions import (
     get_first_calls,
@@ -10,12 +14,37 @@ from hubspot_conversions import (
     get_users,
 )
 
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# structure: {conversion: stage column of the journeys}
+FUNNEL_STAGES = {
+    "First call": "first_call",
+    "Verbal agreement after first call": "first_call_va",
+    "Placement scheduled": "placement",
+}
+# columns of the funnel rows the journeys depend on
+JOURNEY_COLUMNS = [
+    "contact_email",
+    "conversion",
+    "user",
+    "verbal_agreement",
+    "dealstage",
+]
+FUNNEL_STATE_PATH = "./data/funnel_state.pkl"
+
+# structure: {"rows": pd.Series, "journeys": pd.DataFrame, "links": pd.Series, "counts": pd.DataFrame}
+_funnel_state = None
+_funnel_state_lock = threading.Lock()
+
 
 def get_funnel_sankey_panel():
-    funnel_data = get_funnel_data()
+    state = update_funnel_state(get_funnel_data())
 
-    widgets = get_funnel_widgets(funnel_data)
-    sankey_chart = get_sankey_chart(funnel_data)
+    widgets = get_funnel_widgets(
+        get_conversion_stats(state["journeys"], state["counts"])
+    )
+    sankey_chart = get_sankey_chart(state["links"])
     return pn.Column(widgets, sankey_chart)
 
 
@@ -37,7 +66,205 @@ def get_funnel_data():
     return funnel_data
 
 
-def get_sankey_chart(funnel_data: pd.DataFrame):
+def get_journeys(funnel_data: pd.DataFrame) -> pd.DataFrame:
+    """Build the contact x stage table of the funnel in one vectorized pass.
+
+    The contacts and stages are factorized to integer codes once, the flags and the
+    first row of every (contact, stage) cell are then scattered into numpy arrays.
+
+    Returns:
+        pd.DataFrame: Indexed by contact_email (sorted). Per stage of FUNNEL_STAGES a
+            boolean column whether the contact reached it and a categorical "<stage>_user"
+            column with the user of its first row. "verbal_agreement" and "closedwon" tell
+            whether any deal of the contact has a verbal agreement or is won.
+    """
+    contacts, emails = pd.factorize(funnel_data.contact_email, sort=True)
+    journeys = pd.DataFrame(index=pd.Index(emails, name="contact_email"))
+
+    for flag, column, value in [
+        ("verbal_agreement", "verbal_agreement", "true"),
+        ("closedwon", "dealstage", "closedwon"),
+    ]:
+        rows = funnel_data[column].eq(value).fillna(False).to_numpy(dtype=bool)
+        journeys[flag] = np.bincount(contacts[rows], minlength=len(emails)) > 0
+
+    # the first row of every contact and stage, via the few distinct conversions
+    conversions, names = pd.factorize(funnel_data.conversion)
+    # one extra entry for the code -1 of missing conversions
+    stage_of = np.append(pd.Index(list(FUNNEL_STAGES)).get_indexer(names), -1)
+    stage_codes = stage_of[conversions]
+    (rows,) = np.nonzero(stage_codes >= 0)
+    cells = contacts[rows] * len(FUNNEL_STAGES) + stage_codes[rows]
+    first = ~pd.Series(cells).duplicated().to_numpy()
+    cells, rows = cells[first], rows[first]
+
+    # user code of the first row per cell, -1 where the contact didn't reach the stage
+    users, user_names = pd.factorize(funnel_data.user)
+    stage_users = np.full((len(emails), len(FUNNEL_STAGES)), -1)
+    stage_users.flat[cells] = users[rows]
+    reached = np.zeros(stage_users.shape, dtype=bool)
+    reached.flat[cells] = True
+
+    for i, stage in enumerate(FUNNEL_STAGES.values()):
+        journeys[stage] = reached[:, i]
+        journeys[f"{stage}_user"] = pd.Categorical.from_codes(
+            stage_users[:, i], categories=user_names
+        )
+    return journeys
+
+
+def fingerprint_rows(funnel_data: pd.DataFrame) -> pd.Series:
+    """Contact of every funnel row, indexed by a hash of the row's date and the
+    JOURNEY_COLUMNS. A row whose hash is new or gone marks its contact as changed."""
+    hashes = pd.util.hash_pandas_object(funnel_data.index).to_numpy()
+    for column in JOURNEY_COLUMNS:
+        # hash the distinct values only, strings repeat a lot across the rows
+        codes, uniques = pd.factorize(funnel_data[column])
+        value_hashes = pd.util.hash_array(np.asarray(uniques, dtype=object))
+        # one extra entry for the code -1 of missing values
+        hashes = (
+            hashes * np.uint64(1_000_003) ^ np.append(value_hashes, np.uint64(0))[codes]
+        )
+    return pd.Series(funnel_data.contact_email.to_numpy(), index=hashes)
+
+
+def apply_delta(totals, removed, added):
+    """Subtract the counts of the removed journeys and add those of the added ones,
+    dropping the entries that are zero afterwards."""
+    totals = totals.sub(removed, fill_value=0).add(added, fill_value=0)
+    nonzero = totals.ne(0)
+    if isinstance(totals, pd.DataFrame):
+        nonzero = nonzero.any(axis=1)
+    return totals[nonzero].astype(int)
+
+
+def load_funnel_state(path: str = FUNNEL_STATE_PATH):
+    """Load the persisted funnel state, returns None if it doesn't exist yet."""
+    if os.path.exists(path):
+        return pd.read_pickle(path)
+    return None
+
+
+def save_funnel_state(state: dict, path: str = FUNNEL_STATE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pd.to_pickle(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def update_funnel_state(funnel_data: pd.DataFrame) -> dict:
+    """Bring the persisted journeys, Sankey links and conversion counts up to date.
+
+    Only the contacts with new, changed or removed funnel rows are rebuilt. The links
+    and counts are updated by the difference between their old and new journeys. The
+    state is persisted, so a restart doesn't rebuild the whole funnel either.
+
+    Returns:
+        dict: The "journeys", "links" and "counts" of the funnel data.
+    """
+    global _funnel_state
+    start_time = time.time()
+    rows = fingerprint_rows(funnel_data)
+    with _funnel_state_lock:
+        state = _funnel_state if _funnel_state is not None else load_funnel_state()
+        if state is None:
+            journeys = get_journeys(funnel_data)
+            links = get_sankey_links(journeys)
+            counts = count_conversions(journeys)
+            changed = journeys.index
+        else:
+            old_rows = state["rows"]
+            changed = pd.unique(
+                np.concatenate(
+                    [
+                        rows[~rows.index.isin(old_rows.index)].to_numpy(),
+                        old_rows[~old_rows.index.isin(rows.index)].to_numpy(),
+                    ]
+                )
+            )
+            if len(changed) == 0:
+                _funnel_state = state
+                return state
+
+            old_journeys = state["journeys"]
+            is_changed = old_journeys.index.isin(changed)
+            removed = old_journeys[is_changed]
+            added = get_journeys(funnel_data[funnel_data.contact_email.isin(changed)])
+            links = apply_delta(
+                state["links"], get_sankey_links(removed), get_sankey_links(added)
+            )
+            counts = apply_delta(
+                state["counts"], count_conversions(removed), count_conversions(added)
+            )
+            journeys = pd.concat([old_journeys[~is_changed], added]).sort_index()
+            # the user categories of the parts differ
+            user_columns = [f"{stage}_user" for stage in FUNNEL_STAGES.values()]
+            journeys[user_columns] = journeys[user_columns].astype("category")
+
+        state = {"rows": rows, "journeys": journeys, "links": links, "counts": counts}
+        save_funnel_state(state)
+        _funnel_state = state
+    logger.info(
+        f"Updated the funnel of {len(changed)} changed contacts in {round(time.time() - start_time, 2)} seconds"
+    )
+    return state
+
+
+def get_sankey_links(journeys: pd.DataFrame) -> pd.Series:
+    """Number of contacts per funnel transition and the user who handled it.
+
+    Contacts without a first call are not part of the funnel. The transitions out of a
+    verbal agreement after the first call are attributed to its user, the ones out of a
+    placement call to the user of the placement.
+
+    Returns:
+        pd.Series: Counts indexed by (source, target, user).
+    """
+    first_call = journeys.first_call
+    first_call_va = first_call & journeys.first_call_va
+    placement = first_call & journeys.placement
+    placement_va = placement & journeys.verbal_agreement
+    won = journeys.closedwon
+
+    # structure: [(source, target, contacts, user column)]
+    transitions = [
+        (
+            "First Call",
+            "First Call Verbal Agreement",
+            first_call_va,
+            "first_call_va_user",
+        ),
+        (
+            "First Call Verbal Agreement",
+            "Sale",
+            first_call_va & won,
+            "first_call_va_user",
+        ),
+        ("First Call", "Placement Call", placement, "first_call_user"),
+        (
+            "Placement Call",
+            "Placement Verbal Agreement",
+            placement_va,
+            "placement_user",
+        ),
+        ("Placement Verbal Agreement", "Sale", placement_va & won, "placement_user"),
+        ("Placement Call", "Sale", placement & ~placement_va & won, "placement_user"),
+    ]
+    links = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "source": source,
+                    "target": target,
+                    "user": journeys.loc[mask, user].astype(object),
+                }
+            )
+            for source, target, mask, user in transitions
+        ]
+    )
+    return links.groupby(["source", "target", "user"], sort=False, observed=True).size()
+
+
+def get_sankey_chart(links: pd.Series):
     labels = [
         "First Call",
         "First Call Verbal Agreement",
@@ -46,98 +273,6 @@ def get_sankey_chart(funnel_data: pd.DataFrame):
         "Sale",
     ]
 
-    # Define allowed transitions in the funnel
-    transitions = [
-        ("First Call", "First Call Verbal Agreement"),
-        ("First Call", "Placement Call"),
-        ("First Call Verbal Agreement", "Sale"),
-        ("Placement Call", "Placement Verbal Agreement"),
-        ("Placement Call", "Sale"),
-        ("Placement Verbal Agreement", "Sale"),
-    ]
-
-    # Dynamically create sources and targets arrays
-    sources = []
-    targets = []
-    for source_label, target_label in transitions:
-        sources.append(labels.index(source_label))
-        targets.append(labels.index(target_label))
-
-    def get_index(from_conversion, to_conversion):
-        """Get the index in the values array for a specific transition between stages"""
-        try:
-            from_idx = labels.index(from_conversion)
-            to_idx = labels.index(to_conversion)
-
-            for idx, (src, tgt) in enumerate(zip(sources, targets)):
-                if src == from_idx and tgt == to_idx:
-                    return idx
-
-            return -1  # Return -1 if not found
-        except ValueError:
-            return -1  # Return -1 if label not found
-
-    def compute_sankey(group):
-        # Create a list to store individual links
-        links = []  # Each link will be a tuple of (source, target, value, user)
-
-        conversions = group.conversion.values
-        if "First call" not in conversions:
-            return links
-
-        # Process each transition based on the user who handled it
-        if "Verbal agreement after first call" in conversions:
-            # Get the specific user who handled this conversion
-            user = group.user.loc[
-                group.conversion == "Verbal agreement after first call"
-            ].iloc[0]
-            source_idx = labels.index("First Call")
-            target_idx = labels.index("First Call Verbal Agreement")
-            links.append((source_idx, target_idx, 1, user))
-
-            if "closedwon" in group.dealstage.values:
-                source_idx = labels.index("First Call Verbal Agreement")
-                target_idx = labels.index("Sale")
-                links.append((source_idx, target_idx, 1, user))
-
-        if "Placement scheduled" in conversions:
-            # Get the user who scheduled the first call
-            fc_user = group.user.loc[group.conversion == "First call"].iloc[0]
-            source_idx = labels.index("First Call")
-            target_idx = labels.index("Placement Call")
-            links.append((source_idx, target_idx, 1, fc_user))
-
-            # Get the user who scheduled the placement
-            if any(group.conversion == "Placement scheduled"):
-                placement_user = group.user.loc[
-                    group.conversion == "Placement scheduled"
-                ].iloc[0]
-
-                if "true" in group.verbal_agreement.values:
-                    source_idx = labels.index("Placement Call")
-                    target_idx = labels.index("Placement Verbal Agreement")
-                    links.append((source_idx, target_idx, 1, placement_user))
-
-                    if "closedwon" in group.dealstage.values:
-                        source_idx = labels.index("Placement Verbal Agreement")
-                        target_idx = labels.index("Sale")
-                        links.append((source_idx, target_idx, 1, placement_user))
-
-                elif "closedwon" in group.dealstage.values:
-                    source_idx = labels.index("Placement Call")
-                    target_idx = labels.index("Sale")
-                    links.append((source_idx, target_idx, 1, placement_user))
-
-        return links
-
-    # Process data to get individual links
-    all_links = []
-    for email, group_data in funnel_data.groupby("contact_email"):
-        links = compute_sankey(
-            group_data[["conversion", "dealstage", "verbal_agreement", "user"]]
-        )
-        all_links.extend(links)
-
     # Create a dynamic color palette for users
     def generate_color_palette(users):
         """Generate a color palette for users with consistent colors"""
@@ -163,28 +298,18 @@ def get_sankey_chart(funnel_data: pd.DataFrame):
 
         return colors
 
-    # Extract all users from links
-    all_users = [link[3] for link in all_links]
-    user_colors = generate_color_palette(all_users)
-
-    # Group links by source, target, and user
-    link_dict = defaultdict(int)
-    for source, target, value, user in all_links:
-        link_dict[(source, target, user)] += value
+    user_labels = links.index.get_level_values("user").tolist()
+    user_colors = generate_color_palette(user_labels)
 
     # Prepare data for Sankey diagram
-    sources = []
-    targets = []
-    values = []
-    colors = []
-    user_labels = []
-
-    for (source, target, user), value in link_dict.items():
-        sources.append(source)
-        targets.append(target)
-        values.append(value)
-        colors.append(user_colors[user])
-        user_labels.append(user)
+    sources = [
+        labels.index(source) for source in links.index.get_level_values("source")
+    ]
+    targets = [
+        labels.index(target) for target in links.index.get_level_values("target")
+    ]
+    values = links.tolist()
+    colors = [user_colors[user] for user in user_labels]
 
     # Apply the same color scheme to nodes (based on position in funnel)
     node_colors = ["rgba(150, 150, 150, 0.8)"] * len(labels)  # Neutral color for nodes
@@ -266,91 +391,62 @@ def get_sankey_chart(funnel_data: pd.DataFrame):
     return pn.pane.Plotly(fig, sizing_mode="stretch_both")
 
 
-def get_funnel_widgets(funnel_data: pd.DataFrame):
-    # Group data by contact_email to analyze the conversion journey
-    conversion_stats = {}
-
-    # Count event types and conversions for each user
-    for email, group in funnel_data.groupby("contact_email"):
-        conversions = group.conversion.values
-        dealstages = group.dealstage.values
-        verbal_agreements = group.verbal_agreement.values
-        users = group.user.values
-
-        # Track which users handled which events
-        if "First call" in conversions:
-            first_call_user = group.user.loc[group.conversion == "First call"].iloc[0]
-            if first_call_user not in conversion_stats:
-                conversion_stats[first_call_user] = {
-                    "first_call_total": 0,
-                    "first_call_to_sale": 0,
-                    "first_call_va_total": 0,
-                    "first_call_va_to_sale": 0,
-                    "placement_total": 0,
-                    "placement_to_sale": 0,
-                    "placement_va_total": 0,
-                    "placement_va_to_sale": 0,
-                }
-            conversion_stats[first_call_user]["first_call_total"] += 1
-
-            # Check if first call led to sale
-            if "closedwon" in dealstages:
-                conversion_stats[first_call_user]["first_call_to_sale"] += 1
-
-        if "Verbal agreement after first call" in conversions:
-            va_user = group.user.loc[
-                group.conversion == "Verbal agreement after first call"
-            ].iloc[0]
-            if va_user not in conversion_stats:
-                conversion_stats[va_user] = {
-                    "first_call_total": 0,
-                    "first_call_to_sale": 0,
-                    "first_call_va_total": 0,
-                    "first_call_va_to_sale": 0,
-                    "placement_total": 0,
-                    "placement_to_sale": 0,
-                    "placement_va_total": 0,
-                    "placement_va_to_sale": 0,
-                }
-            conversion_stats[va_user]["first_call_va_total"] += 1
-
-            # Check if verbal agreement led to sale
-            if "closedwon" in dealstages:
-                conversion_stats[va_user]["first_call_va_to_sale"] += 1
-
-        if "Placement scheduled" in conversions:
-            placement_user = group.user.loc[
-                group.conversion == "Placement scheduled"
-            ].iloc[0]
-            if placement_user not in conversion_stats:
-                conversion_stats[placement_user] = {
-                    "first_call_total": 0,
-                    "first_call_to_sale": 0,
-                    "first_call_va_total": 0,
-                    "first_call_va_to_sale": 0,
-                    "placement_total": 0,
-                    "placement_to_sale": 0,
-                    "placement_va_total": 0,
-                    "placement_va_to_sale": 0,
-                }
-            conversion_stats[placement_user]["placement_total"] += 1
+def count_conversions(journeys: pd.DataFrame) -> pd.DataFrame:
+    """Count the journeys per user who handled the stage and their sales.
+
+    Returns:
+        pd.DataFrame: Counts per user.
+    """
+    won = journeys.closedwon
+    placement_va = journeys.placement & journeys.verbal_agreement
+
+    # structure: {stat: (contacts, user column)}
+    counts = {
+        "first_call_total": (journeys.first_call, "first_call_user"),
+        "first_call_to_sale": (journeys.first_call & won, "first_call_user"),
+        "first_call_va_total": (journeys.first_call_va, "first_call_va_user"),
+        "first_call_va_to_sale": (journeys.first_call_va & won, "first_call_va_user"),
+        "placement_total": (journeys.placement, "placement_user"),
+        "placement_to_sale": (journeys.placement & won, "placement_user"),
+        "placement_va_total": (placement_va, "placement_user"),
+        "placement_va_to_sale": (placement_va & won, "placement_user"),
+    }
+    stats = pd.DataFrame(
+        {
+            stat: journeys.loc[mask, user].astype(object).value_counts()
+            for stat, (mask, user) in counts.items()
+        }
+    )
+    return stats.fillna(0).astype(int)
 
-            # Check if placement led to sale
-            if "closedwon" in dealstages:
-                conversion_stats[placement_user]["placement_to_sale"] += 1
 
-            # Check if placement had verbal agreement
-            if "true" in verbal_agreements:
-                conversion_stats[placement_user]["placement_va_total"] += 1
+def get_conversion_stats(
+    journeys: pd.DataFrame, counts: pd.DataFrame | None = None
+) -> pd.DataFrame:
+    """Conversion counts per user, in the order users first appear in the journeys.
+
+    Args:
+        journeys (pd.DataFrame): Journeys from get_journeys
+        counts (pd.DataFrame, optional): Counts of the journeys from count_conversions,
+            counted if not given.
+    """
+    if counts is None:
+        counts = count_conversions(journeys)
+
+    stages = list(FUNNEL_STAGES.values())
+    users = journeys[[f"{stage}_user" for stage in stages]].where(
+        journeys[stages].to_numpy()
+    )
+    order = pd.unique(users.to_numpy().ravel())
+    return counts.reindex(order[pd.notna(order)]).fillna(0).astype(int)
+
 
-                # Check if placement VA led to sale
-                if "closedwon" in dealstages:
-                    conversion_stats[placement_user]["placement_va_to_sale"] += 1
+def get_funnel_widgets(conversion_stats: pd.DataFrame):
 
     # Create widgets to display conversion stats
     widgets = []
 
-    for user, stats in conversion_stats.items():
+    for user, stats in conversion_stats.iterrows():
         user_metrics = []
 
         # First Call → Sale
@@ -0,0 +1,207 @@
+"""
+Local columnar store for time indexed data, partitioned by source and period.
+
+Every partition is a parquet file at <path>/<source>/<period>.parquet. A manifest per
+source keeps a checksum of each partition, so appends only write the periods that are
+new or changed and reads only load the periods within the requested range.
+"""
+
+import datetime
+import json
+import os
+
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+
+PERIOD_FORMATS = {
+    "D": "%Y-%m-%d",
+    "h": "%Y-%m-%dT%H",
+    "MS": "%Y-%m",
+}
+
+
+class PartitionStore:
+    def __init__(self, path: str, freq: str = "D"):
+        """
+        Args:
+            path (str): Root directory of the store
+            freq (str, optional): Partition period, "D" (daily), "h" (hourly)
+                or "MS" (monthly). Defaults to "D".
+        """
+        self.path = path
+        self.freq = freq
+        self.period_format = PERIOD_FORMATS[freq]
+
+    def _partition_path(self, source: str, key: str) -> str:
+        return os.path.join(self.path, source, f"{key}.parquet")
+
+    def _manifest_path(self, source: str) -> str:
+        return os.path.join(self.path, source, "manifest.json")
+
+    def _floor(self, time):
+        """Start of the partition period of a timestamp or datetime index."""
+        if self.freq == "MS":
+            # months have no fixed length, so they can't be floored to
+            return time.to_period("M").to_timestamp()
+        return time.floor(self.freq)
+
+    def _to_key(self, period: pd.Timestamp) -> str:
+        return period.strftime(self.period_format)
+
+    def _to_period(self, key: str) -> pd.Timestamp:
+        return pd.Timestamp(datetime.datetime.strptime(key, self.period_format))
+
+    def sources(self) -> list[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(
+            source
+            for source in os.listdir(self.path)
+            if os.path.exists(self._manifest_path(source))
+        )
+
+    def load_manifest(self, source: str) -> dict:
+        """Returns {period_key: checksum} of the stored partitions of a source."""
+        path = self._manifest_path(source)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def _save_manifest(self, source: str, manifest: dict):
+        path = self._manifest_path(source)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+    def periods(self, source: str) -> list[pd.Timestamp]:
+        return sorted(self._to_period(key) for key in self.load_manifest(source))
+
+    def bounds(self, sources: list[str] | None = None):
+        """First and last stored period over the given sources (all by default)."""
+        periods = [p for s in sources or self.sources() for p in self.periods(s)]
+        if not periods:
+            return None, None
+        return min(periods), max(periods)
+
+    def append(self, source: str, df: pd.DataFrame) -> int:
+        """Write the partitions of the dataframe that are new or changed.
+
+        Stored partitions within the period range of the dataframe that have no rows
+        anymore are removed.
+
+        Args:
+            source (str): Name of the source
+            df (pd.DataFrame): Dataframe with a datetime index
+
+        Returns:
+            int: Number of written partitions
+        """
+        os.makedirs(os.path.join(self.path, source), exist_ok=True)
+        manifest = self.load_manifest(source)
+        df = df.copy()
+        df.index = pd.to_datetime(df.index)
+        periods = self._floor(df.index)
+
+        written = 0
+        present = set()
+        for period, partition in df.groupby(periods):
+            key = self._to_key(period)
+            present.add(key)
+            checksum = str(pd.util.hash_pandas_object(partition).sum())
+            if manifest.get(key) == checksum:
+                continue
+            # replaced atomically, readers never see a partly written partition
+            path = self._partition_path(source, key)
+            partition.to_parquet(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            manifest[key] = checksum
+            written += 1
+
+        if not df.empty:
+            start, end = periods.min(), periods.max()
+            for key in list(manifest):
+                if key not in present and start <= self._to_period(key) <= end:
+                    os.remove(self._partition_path(source, key))
+                    del manifest[key]
+
+        self._save_manifest(source, manifest)
+        return written
+
+    def period_bounds(self, start, end) -> tuple[pd.Timestamp, pd.Timestamp]:
+        """Start of the partition of start and the last instant of the partition of
+        end, the range of whole partitions covering start to end."""
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        return (
+            self._floor(start),
+            self._floor(end) + to_offset(self.freq) - pd.Timedelta(1, "ns"),
+        )
+
+    def upsert(self, source: str, df: pd.DataFrame) -> int:
+        """Merge the rows of the dataframe into the stored partitions it touches.
+
+        Stored rows within the time range of the dataframe are replaced by its rows,
+        stored rows outside of it are kept, so a range that starts or ends within a
+        partition doesn't drop the rest of the partition.
+
+        Args:
+            source (str): Name of the source
+            df (pd.DataFrame): Dataframe with a datetime index
+
+        Returns:
+            int: Number of written partitions
+        """
+        if df.empty:
+            return 0
+        df = df.copy()
+        df.index = pd.to_datetime(df.index)
+        start, end = df.index.min(), df.index.max()
+        stored = self.read(*self.period_bounds(start, end), sources=[source])
+        if not stored.empty:
+            kept = stored[(stored.index < start) | (stored.index > end)]
+            merged = pd.concat([kept, df]).sort_index(kind="stable")
+            # categories of the stored and new rows differ, concat falls back to object
+            df = merged.astype(
+                {col: "category" for col in df.select_dtypes("category").columns}
+            )
+        return self.append(source, df)
+
+    def read(
+        self,
+        start=None,
+        end=None,
+        sources: list[str] | None = None,
+    ) -> pd.DataFrame:
+        """Read the rows between start and end (inclusive) of the given sources.
+
+        Only the partitions overlapping the range are loaded. The rows are sorted by
+        time.
+        """
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        frames = []
+        for source in sources or self.sources():
+            for key in sorted(self.load_manifest(source)):
+                period = self._to_period(key)
+                if start is not None and period < self._floor(start):
+                    continue
+                if end is not None and period > end:
+                    continue
+                frames.append(pd.read_parquet(self._partition_path(source, key)))
+        if not frames:
+            return pd.DataFrame()
+
+        # sorted, so the range is a slice whose bounds are found by binary search
+        data = pd.concat(frames).sort_index(kind="stable")
+        # bounds finer than the index (e.g. the last nanosecond of a partition) are
+        # rounded inwards, binary search needs them in the unit of the index
+        unit = data.index.unit
+        if start is not None:
+            start = start.ceil(unit).as_unit(unit)
+        if end is not None:
+            end = end.floor(unit).as_unit(unit)
+        first = data.index.searchsorted(start, side="left") if start is not None else 0
+        last = (
+            data.index.searchsorted(end, side="right") if end is not None else len(data)
+        )
+        return data.iloc[first:last]
@@ -1,34 +1,190 @@
 import functools
+import hashlib
+import pickle
+import sys
+import threading
 import time
+from collections import OrderedDict
 
-# Simple cache storage
-_cache = {}
+import numpy as np
+import pandas as pd
 
+# All caches created by timed_cache, so they can be cleared together
+_caches = []
 
-def timed_cache(seconds=600):  # Default 10 minutes (600 seconds)
+
+def _digest(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _content_digest(obj) -> str:
+    """Digest of all values of a DataFrame, Series or array, in vectorized passes."""
+    try:
+        if isinstance(obj, np.ndarray):
+            if obj.dtype == object:
+                return _digest(pd.util.hash_array(obj.ravel()).tobytes())
+            return _digest(np.ascontiguousarray(obj).tobytes())
+        return _digest(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+    except TypeError:
+        # unhashable values (lists, dicts, ...) are serialized instead
+        return _digest(pickle.dumps(obj))
+
+
+def make_key(obj):
+    """Build a hashable key that describes an argument.
+
+    DataFrames, Series and arrays are not stringified, their key consists of type,
+    shape, columns, dtypes and a digest of all values (and the index), hashed in one
+    vectorized pass. Objects with the same key have the same content.
+    """
+    if isinstance(obj, (str, bytes, int, float, bool, type(None))):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, tuple(make_key(o) for o in obj))
+    if isinstance(obj, dict):
+        return (
+            "dict",
+            tuple(sorted((repr(k), make_key(v)) for k, v in obj.items())),
+        )
+    if isinstance(obj, (set, frozenset)):
+        return ("set", tuple(sorted(repr(make_key(o)) for o in obj)))
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return (
+            type(obj).__name__,
+            obj.shape,
+            tuple(obj.columns) if isinstance(obj, pd.DataFrame) else obj.name,
+            tuple(map(str, obj.dtypes))
+            if isinstance(obj, pd.DataFrame)
+            else str(obj.dtype),
+            _content_digest(obj),
+        )
+    if isinstance(obj, np.ndarray):
+        return ("ndarray", obj.shape, str(obj.dtype), _content_digest(obj))
+    try:
+        hash(obj)
+        return obj
+    except TypeError:
+        return (type(obj).__name__, repr(obj))
+
+
+def _size_of(value) -> int:
+    """Approximate size of a cached value in bytes."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(index=True, deep=False).sum())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_size_of(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class TimedLRUCache:
+    """Thread-safe cache bounded by number of entries and bytes, evicting expired
+    entries first and then the least recently used ones."""
+
+    def __init__(self, seconds=600, max_entries=128, max_bytes=256 * 1024**2):
+        self.seconds = seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # structure: {key: (result, timestamp, size)}
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        """Returns (True, result) for a valid entry, (False, None) otherwise."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] < self.seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[0]
+            if entry is not None:
+                self._remove(key)
+                self.evictions += 1
+            self.misses += 1
+            return False, None
+
+    def set(self, key, result):
+        size = _size_of(result)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (result, time.time(), size)
+            self._bytes += size
+            self._evict()
+
+    def _evict(self):
+        # Expired entries first
+        current_time = time.time()
+        for key in [
+            k
+            for k, (_, timestamp, _) in self._entries.items()
+            if current_time - timestamp >= self.seconds
+        ]:
+            self._remove(key)
+            self.evictions += 1
+        # Then the least recently used ones
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+def timed_cache(seconds=600, max_entries=128, max_bytes=256 * 1024**2):
     """
     Decorator that caches the result of a function call for a specified duration.
     Default cache duration is 10 minutes (600 seconds).
+
+    The cache of each function holds at most max_entries results and max_bytes
+    (approximately), least recently used results are evicted first. Hit, miss and
+    eviction counters are available through `func.cache_info()`.
     """
 
     def decorator(func):
+        cache = TimedLRUCache(seconds, max_entries, max_bytes)
+        _caches.append(cache)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             # Create a unique key based on function name and arguments
-            key = str((func.__name__, args, frozenset(kwargs.items())))
-            current_time = time.time()
+            key = (func.__name__, make_key(args), make_key(kwargs))
 
             # Check if result is in cache and still valid
-            if key in _cache:
-                result, timestamp = _cache[key]
-                if current_time - timestamp < seconds:
-                    return result
+            found, result = cache.get(key)
+            if found:
+                return result
 
             # Call the function and cache the result
             result = func(*args, **kwargs)
-            _cache[key] = (result, current_time)
+            cache.set(key, result)
             return result
 
+        wrapper.cache = cache
+        wrapper.cache_info = cache.info
         return wrapper
 
     return decorator
@@ -36,4 +192,5 @@ def timed_cache(seconds=600):  # Default 10 minutes (600 seconds)
 
 def clear_cache():
     """Clear the entire cache"""
-    _cache.clear()
+    for cache in _caches:
+        cache.clear()
@@ -0,0 +1,72 @@
+"""
+Single-flight request coalescing for expensive data source fetches.
+
+While a call of a decorated function is in flight, concurrent calls with the same
+arguments wait for it and share its result (or exception) instead of starting their
+own fetch.
+"""
+
+import functools
+import logging
+import threading
+
+from simple_cache import make_key
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_in_flight = {}
+_lock = threading.Lock()
+# structure: {function_name: {"calls": int, "coalesced": int}}
+_stats = {}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def single_flight(func):
+    """Decorator that coalesces concurrent calls with the same arguments into one."""
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (name, make_key(args), make_key(kwargs))
+        with _lock:
+            stats = _stats.setdefault(name, {"calls": 0, "coalesced": 0})
+            stats["calls"] += 1
+            call = _in_flight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = _in_flight[key] = _Call()
+            else:
+                stats["coalesced"] += 1
+
+        if not is_leader:
+            logger.debug(f"Waiting for the running call of {name}")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with _lock:
+                del _in_flight[key]
+            call.done.set()
+
+    return wrapper
+
+
+def single_flight_stats() -> dict:
+    """Number of calls and coalesced calls per decorated function."""
+    with _lock:
+        return {name: dict(stats) for name, stats in _stats.items()}
@@ -0,0 +1,54 @@
+"""
+Measures the phases of the dashboard start, so it's visible where boot time goes.
+
+Usage:
+    with timed("imports"):
+        import ...
+    log_report()
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Phases since the last report, `panel serve` runs the script once per session but
+# imports only once, so only the first report covers the whole boot
+# structure: {phase: seconds}
+STARTUP_TIMES = {}
+_booted = False
+
+
+@contextmanager
+def timed(phase: str):
+    """Add the time spent in the block to the phase."""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMES[phase] = (
+            STARTUP_TIMES.get(phase, 0) + time.perf_counter() - start_time
+        )
+
+
+def log_report():
+    """Log the time spent per phase since the last report, slowest first, and reset
+    the phases. The first report is the boot, later ones the start of a session."""
+    global _booted
+    total = sum(STARTUP_TIMES.values()) or 1
+    lines = [
+        f"{phase:<30}{seconds:>8.2f}s{seconds / total * 100:>7.1f}%"
+        for phase, seconds in sorted(
+            STARTUP_TIMES.items(), key=lambda item: item[1], reverse=True
+        )
+    ]
+    title = "Session start time report" if _booted else "Startup time report"
+    logger.info(
+        f"{title}:\n"
+        + "\n".join(lines)
+        + f"\n{'total':<30}{sum(STARTUP_TIMES.values()):>8.2f}s"
+    )
+    STARTUP_TIMES.clear()
+    _booted = True
@@ -0,0 +1,65 @@
+"""
+Overlapping syncs of the hourly store must keep the stored hours and rollups outside
+of the fetched window.
+
+Usage:
+    python -m pytest tests
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import fetch_api
+from partition_store import PartitionStore
+
+
+def ads_rows(start: str, end: str) -> pd.DataFrame:
+    """Ads rows every 20 minutes between start and end, 1 spend each."""
+    index = pd.date_range(start, end, freq="20min", inclusive="left", name="date")
+    return pd.DataFrame(
+        {
+            "campaign": np.where(np.arange(len(index)) % 2, "a", "b"),
+            "spend": 1.0,
+            "impressions": 10,
+            "clicks": 1,
+            "reach": 5,
+        },
+        index=index,
+    )
+
+
+@pytest.fixture
+def hourly_stores(tmp_path, monkeypatch):
+    stores = {
+        "h": PartitionStore(str(tmp_path / "h"), freq="D"),
+        "4h": PartitionStore(str(tmp_path / "4h"), freq="D"),
+        "D": PartitionStore(str(tmp_path / "D"), freq="MS"),
+    }
+    monkeypatch.setattr(fetch_api, "HOURLY_STORES", stores)
+    return stores
+
+
+def sync(monkeypatch, rows: pd.DataFrame):
+    monkeypatch.setattr(fetch_api, "HOURLY_SOURCES", {"facebook": (lambda: rows, 10)})
+    monkeypatch.setattr(fetch_api, "_last_hourly_sync", 0.0)
+    fetch_api.sync_hourly_store()
+
+
+def test_overlapping_syncs_keep_earlier_hours_and_days(hourly_stores, monkeypatch):
+    sync(monkeypatch, ads_rows("2025-01-01", "2025-02-16"))
+    # starts within a day and a month of the first window
+    sync(monkeypatch, ads_rows("2025-01-20 10:00", "2025-02-21"))
+
+    expected = ads_rows("2025-01-01", "2025-02-21")
+    for resolution, store in hourly_stores.items():
+        stored = store.read(sources=["facebook"])
+        totals = stored.groupby(level=0)["spend"].sum()
+        expected_totals = expected["spend"].resample(resolution).sum()
+        pd.testing.assert_series_equal(
+            totals,
+            expected_totals,
+            check_names=False,
+            check_freq=False,
+            check_dtype=False,
+        )